@@ -0,0 +1,223 @@
+"""Admission control for the memory-heavy upload and download routes.
+
+An upload holds the raw file, its base64 copy and the BSON document at the
+same time, so each request is charged ``Content-Length * memory_factor``
+against a global byte budget. Requests that do not fit wait in a short,
+bounded queue; beyond that they are turned away with ``Retry-After`` rather
+than piling up until the process runs out of memory.
+
+Per-client limits only apply to uploads. Downloads are cheap and a gallery
+page fires dozens at once, so they only queue on the global budget. Behind
+reverse proxies every request comes from the nearest proxy's address; set
+``ADMISSION_TRUSTED_PROXIES`` to the number of proxies in front of the app.
+Each proxy appends the address it saw to ``X-Forwarded-For``, so the client
+is the entry that many places from the right; anything further left was
+written by the client itself and is ignored.
+"""
+import asyncio
+import json
+import os
+import re
+
+UPLOAD_ROUTES = [
+    ("POST", re.compile(r"^/api/projects/[^/]+/images(/ingest)?$")),
+    ("POST", re.compile(r"^/api/projects/[^/]+/floorplans$")),
+]
+DOWNLOAD_ROUTES = [
+    ("GET", re.compile(r"^/api/images/[^/]+/data$")),
+    ("GET", re.compile(r"^/api/floorplans/[^/]+/data$")),
+    ("GET", re.compile(r"^/api/floorplans/[^/]+/render$")),
+]
+
+
+class AdmissionController:
+    def __init__(self, max_bytes: int, max_concurrent: int, max_queue: int, queue_timeout: float,
+                 client_max_concurrent: int, client_max_bytes: int, retry_after: int):
+        self.max_bytes = max_bytes
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.client_max_concurrent = client_max_concurrent
+        self.client_max_bytes = client_max_bytes
+        self.retry_after = retry_after
+
+        self.in_flight = 0
+        self.bytes_in_use = 0
+        self.waiting = 0
+        self.clients = {}
+        self.counters = {"admitted": 0, "queued": 0, "rejected_busy": 0, "rejected_quota": 0,
+                         "rejected_too_large": 0, "timed_out": 0}
+        self._cond = None
+
+    def _fits(self, cost: int) -> bool:
+        return self.in_flight < self.max_concurrent and self.bytes_in_use + cost <= self.max_bytes
+
+    async def acquire(self, client, cost: int):
+        """Reserve capacity; returns None when admitted, else the HTTP status to reject with.
+
+        ``client`` is None for requests that are not subject to per-client quotas.
+        """
+        if cost > self.max_bytes or (client is not None and cost > self.client_max_bytes):
+            self.counters["rejected_too_large"] += 1
+            return 413
+
+        if client is not None:
+            usage = self.clients.setdefault(client, [0, 0])
+            if usage[0] >= self.client_max_concurrent or usage[1] + cost > self.client_max_bytes:
+                self.counters["rejected_quota"] += 1
+                return 429
+            usage[0] += 1
+            usage[1] += cost
+
+        if self.waiting == 0 and self._fits(cost):
+            self._admit(cost)
+            return None
+
+        if self.waiting >= self.max_queue:
+            self._release_client(client, cost)
+            self.counters["rejected_busy"] += 1
+            return 503
+
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        self.waiting += 1
+        self.counters["queued"] += 1
+        admitted = False
+        try:
+            async with self._cond:
+                await asyncio.wait_for(self._cond.wait_for(lambda: self._fits(cost)), self.queue_timeout)
+                self._admit(cost)
+                admitted = True
+                return None
+        except asyncio.TimeoutError:
+            self.counters["timed_out"] += 1
+            return 503
+        finally:
+            self.waiting -= 1
+            # Also runs when the waiter is cancelled (client gone, shutdown).
+            if not admitted:
+                self._release_client(client, cost)
+
+    async def release(self, client, cost: int):
+        self.in_flight -= 1
+        self.bytes_in_use -= cost
+        self._release_client(client, cost)
+        if self._cond is not None and self.waiting:
+            async with self._cond:
+                self._cond.notify_all()
+
+    def _admit(self, cost: int):
+        self.in_flight += 1
+        self.bytes_in_use += cost
+        self.counters["admitted"] += 1
+
+    def _release_client(self, client, cost: int):
+        if client is None:
+            return
+        usage = self.clients[client]
+        usage[0] -= 1
+        usage[1] -= cost
+        if usage[0] <= 0:
+            del self.clients[client]
+
+    def snapshot(self):
+        return {
+            "in_flight": self.in_flight,
+            "bytes_in_use": self.bytes_in_use,
+            "queue_depth": self.waiting,
+            "clients": len(self.clients),
+            "limits": {
+                "max_bytes": self.max_bytes,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "client_max_concurrent": self.client_max_concurrent,
+                "client_max_bytes": self.client_max_bytes,
+            },
+            **self.counters,
+        }
+
+
+REJECT_DETAILS = {
+    400: "Érvénytelen Content-Length fejléc",
+    411: "Hiányzó Content-Length fejléc",
+    413: "A fájl túl nagy",
+    429: "Túl sok párhuzamos kérés",
+    503: "A szerver túlterhelt, próbálja újra később",
+}
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller: AdmissionController, memory_factor: float = 3.0,
+                 download_bytes: int = 4 * 1024 * 1024, trusted_proxies: int = 0):
+        self.app = app
+        self.controller = controller
+        self.memory_factor = memory_factor
+        self.download_bytes = download_bytes
+        self.trusted_proxies = trusted_proxies
+
+    def _client(self, scope, headers):
+        if self.trusted_proxies and b"x-forwarded-for" in headers:
+            hops = [h.strip() for h in headers[b"x-forwarded-for"].split(b",")]
+            if len(hops) >= self.trusted_proxies:
+                return hops[-self.trusted_proxies].decode("latin-1")
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method, path = scope["method"], scope["path"]
+        if any(m == method and p.match(path) for m, p in UPLOAD_ROUTES):
+            headers = dict(scope["headers"])
+            length = headers.get(b"content-length")
+            if length is None:
+                return await self._reject(send, 411)
+            try:
+                length = int(length)
+            except ValueError:
+                return await self._reject(send, 400)
+            if length < 0:
+                return await self._reject(send, 400)
+            cost = int(length * self.memory_factor)
+            client = self._client(scope, headers)
+        elif any(m == method and p.match(path) for m, p in DOWNLOAD_ROUTES):
+            cost = self.download_bytes
+            client = None
+        else:
+            return await self.app(scope, receive, send)
+
+        status = await self.controller.acquire(client, cost)
+        if status is not None:
+            return await self._reject(send, status)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.controller.release(client, cost)
+
+    async def _reject(self, send, status: int):
+        body = json.dumps({"detail": REJECT_DETAILS[status]}, ensure_ascii=False).encode("utf-8")
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        if status in (429, 503):
+            headers.append((b"retry-after", str(self.controller.retry_after).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+def admission_from_env():
+    mb = 1024 * 1024
+    controller = AdmissionController(
+        max_bytes=int(os.environ.get("ADMISSION_MAX_BYTES", str(512 * mb))),
+        max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", "16")),
+        max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "32")),
+        queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "5")),
+        client_max_concurrent=int(os.environ.get("ADMISSION_CLIENT_MAX_CONCURRENT", "4")),
+        client_max_bytes=int(os.environ.get("ADMISSION_CLIENT_MAX_BYTES", str(192 * mb))),
+        retry_after=int(os.environ.get("ADMISSION_RETRY_AFTER", "2")),
+    )
+    options = {
+        "memory_factor": float(os.environ.get("ADMISSION_MEMORY_FACTOR", "3.0")),
+        "download_bytes": int(os.environ.get("ADMISSION_DOWNLOAD_BYTES", str(4 * mb))),
+        "trusted_proxies": int(os.environ.get("ADMISSION_TRUSTED_PROXIES", "0")),
+    }
+    return controller, options
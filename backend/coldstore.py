@@ -0,0 +1,172 @@
+"""Compressed cold tier for archived projects, with a read-through cache.
+
+Archived payloads are zlib-compressed and written to a local directory or an
+S3-compatible bucket; the Mongo document keeps its metadata and gains a
+``cold`` reference instead of ``data``. Reads go memory LRU -> local disk
+cache -> cold store, and every fetch from the cold store is hash-checked.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+from storage import LocalBlobStore, S3BlobStore
+
+ROOT_DIR = Path(__file__).parent
+
+
+class ColdStore:
+    def __init__(self, store, cache_dir, memory_bytes: int, disk_bytes: int, level: int = 6):
+        self.store = store
+        self.level = level
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "fetches": 0}
+        # The disk cache is indexed in memory (name -> size, least recently
+        # used first), so eviction never has to list the directory again.
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        entries = []
+        for p in self.cache_dir.iterdir():
+            if p.suffix == ".tmp":
+                p.unlink(missing_ok=True)
+                continue
+            stat = p.stat()
+            entries.append((stat.st_mtime, p.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.disk[name] = size
+            self.disk_size += size
+
+    def put(self, key: str, raw: bytes) -> dict:
+        compressed = zlib.compress(raw, self.level)
+        sha256 = hashlib.sha256(raw).hexdigest()
+        self.store.put(key, io.BytesIO(compressed), metadata={"sha256": sha256, "codec": "zlib"})
+        return {
+            "backend": self.store.backend,
+            "key": key,
+            "codec": "zlib",
+            "size": len(raw),
+            "stored_size": len(compressed),
+            "sha256": sha256,
+        }
+
+    def fetch(self, ref: dict) -> bytes:
+        sha256 = ref["sha256"]
+        with self.lock:
+            raw = self.memory.get(sha256)
+            if raw is not None:
+                self.memory.move_to_end(sha256)
+                self.counters["memory_hits"] += 1
+                return raw
+
+        disk_path = self.cache_dir / sha256
+        try:
+            raw = disk_path.read_bytes()
+            with self.lock:
+                if sha256 in self.disk:
+                    self.disk.move_to_end(sha256)
+                self.counters["disk_hits"] += 1
+        except FileNotFoundError:
+            raw = zlib.decompress(self.store.get(ref["key"]))
+            if hashlib.sha256(raw).hexdigest() != sha256:
+                raise ValueError(f"hash mismatch for cold object {ref['key']}")
+            with self.lock:
+                self.counters["fetches"] += 1
+            self._write_disk(disk_path, raw)
+
+        self._remember(sha256, raw)
+        return raw
+
+    def delete(self, ref: dict):
+        self.store.delete(ref["key"])
+        self.forget(ref["sha256"])
+
+    def delete_prefix(self, prefix: str):
+        self.store.delete_prefix(prefix)
+
+    def forget(self, sha256: str):
+        with self.lock:
+            raw = self.memory.pop(sha256, None)
+            if raw is not None:
+                self.memory_size -= len(raw)
+            self.disk_size -= self.disk.pop(sha256, 0)
+        (self.cache_dir / sha256).unlink(missing_ok=True)
+
+    def _remember(self, sha256: str, raw: bytes):
+        if len(raw) > self.memory_bytes:
+            return
+        with self.lock:
+            if sha256 in self.memory:
+                return
+            self.memory[sha256] = raw
+            self.memory_size += len(raw)
+            while self.memory_size > self.memory_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def _write_disk(self, path: Path, raw: bytes):
+        if len(raw) > self.disk_bytes:
+            return
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False) as tmp:
+            tmp.write(raw)
+        os.replace(tmp.name, path)
+
+        evict = []
+        with self.lock:
+            self.disk_size += len(raw) - self.disk.pop(path.name, 0)
+            self.disk[path.name] = len(raw)
+            while self.disk_size > self.disk_bytes:
+                name, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                evict.append(name)
+        for name in evict:
+            (self.cache_dir / name).unlink(missing_ok=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": self.store.backend,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_size,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_size,
+                **self.counters,
+            }
+
+
+def cold_store_from_env():
+    kind = os.environ.get("COLD_STORAGE", "").lower()
+    if not kind:
+        return None
+    if kind == "local":
+        store = LocalBlobStore(os.environ.get("COLD_STORAGE_DIR") or ROOT_DIR / "cold_storage")
+    elif kind == "s3":
+        store = S3BlobStore(
+            os.environ["COLD_S3_BUCKET"],
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+            region=os.environ.get("S3_REGION") or None,
+        )
+    else:
+        raise ValueError(f"unknown COLD_STORAGE {kind!r}")
+
+    mb = 1024 * 1024
+    return ColdStore(
+        store,
+        cache_dir=os.environ.get("COLD_CACHE_DIR") or ROOT_DIR / "cold_cache",
+        memory_bytes=int(os.environ.get("COLD_CACHE_MEMORY_BYTES", str(64 * mb))),
+        disk_bytes=int(os.environ.get("COLD_CACHE_DISK_BYTES", str(1024 * mb))),
+        level=int(os.environ.get("COLD_COMPRESSION_LEVEL", "6")),
+    )
+
+
+def cold_key(collection: str, project_id: str, doc_id: str = "") -> str:
+    return f"cold/{collection}/{project_id}/{doc_id}"
@@ -0,0 +1,131 @@
+"""Background processing for images uploaded through the ingest endpoint.
+
+The request handler only stores the raw bytes in ``image_uploads`` and an
+image document with ``status: "processing"``; a fixed number of workers then
+do the derived work (hashing, encoding, dimensions) and flip the image to
+``ready`` or, after the last retry, ``failed``.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+
+from pymongo import ReturnDocument
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # Pillow is optional; dimensions are skipped without it
+    PILImage = None
+
+logger = logging.getLogger(__name__)
+
+
+def derive(raw: bytes) -> dict:
+    derived = {
+        "data": base64.b64encode(raw).decode('utf-8'),
+        "sha256": hashlib.sha256(raw).hexdigest(),
+        "size": len(raw),
+    }
+    if PILImage is not None:
+        try:
+            with PILImage.open(io.BytesIO(raw)) as img:
+                derived["width"], derived["height"] = img.size
+        except Exception:
+            pass
+    return derived
+
+
+class IngestPool:
+    def __init__(self, workers: int = 2, max_attempts: int = 3, retry_delay: float = 1.0, on_ready=None):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.on_ready = on_ready
+        self.db = None
+        self.queue = None
+        self.queued = set()
+        self.tasks = set()
+
+    def start(self, db):
+        self.db = db
+        self.queue = asyncio.Queue()
+        for _ in range(self.workers):
+            self._spawn(self._worker())
+
+    async def recover(self):
+        # Uploads accepted before a restart are still in image_uploads.
+        async for upload in self.db.image_uploads.find({"failed": {"$ne": True}}, {"_id": 0, "id": 1}):
+            self.submit(upload["id"])
+
+    async def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def submit(self, image_id: str):
+        # An id already waiting in the queue is not added twice.
+        if image_id in self.queued:
+            return
+        self.queued.add(image_id)
+        self.queue.put_nowait(image_id)
+
+    def stats(self):
+        return {"workers": self.workers, "queued": self.queue.qsize() if self.queue else 0}
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _retry_later(self, image_id: str, delay: float):
+        await asyncio.sleep(delay)
+        self.submit(image_id)
+
+    async def _worker(self):
+        while True:
+            image_id = await self.queue.get()
+            self.queued.discard(image_id)
+            try:
+                await self._process(image_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self._failed(image_id, e)
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, image_id: str):
+        upload = await self.db.image_uploads.find_one({"id": image_id})
+        if not upload:
+            return
+
+        derived = await asyncio.to_thread(derive, bytes(upload["raw"]))
+        result = await self.db.images.update_one(
+            {"id": image_id},
+            {"$set": {**derived, "status": "ready"}, "$unset": {"error": ""}}
+        )
+        await self.db.image_uploads.delete_one({"id": image_id})
+        if result.matched_count and self.on_ready:
+            await self.on_ready(upload["project_id"])
+
+    async def _failed(self, image_id: str, error: Exception):
+        upload = await self.db.image_uploads.find_one_and_update(
+            {"id": image_id}, {"$inc": {"attempts": 1}}, projection={"_id": 0, "attempts": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not upload:
+            return
+        attempts = upload["attempts"]
+        if attempts < self.max_attempts:
+            logger.warning("Ingest of %s failed (attempt %d), retrying: %s", image_id, attempts, error)
+            await self.db.images.update_one({"id": image_id}, {"$set": {"attempts": attempts}})
+            self._spawn(self._retry_later(image_id, self.retry_delay * 2 ** (attempts - 1)))
+            return
+
+        logger.error("Ingest of %s failed after %d attempts: %s", image_id, attempts, error)
+        # The raw upload is kept so a failed image can be inspected or reprocessed.
+        await self.db.image_uploads.update_one({"id": image_id}, {"$set": {"failed": True}})
+        await self.db.images.update_one(
+            {"id": image_id}, {"$set": {"status": "failed", "attempts": attempts, "error": str(error)}}
+        )
@@ -0,0 +1,251 @@
+"""Move inline base64 image/floorplan payloads out of MongoDB into the blob store.
+
+Walks ``images`` and ``floorplans`` in ``_id`` order, uploads each decoded
+payload under the same key the presigned upload flow uses, verifies the
+stored object's SHA-256, then swaps the document to a ``blob`` reference and
+``$unset``s ``data``. Progress is checkpointed after every batch, so an
+interrupted run picks up where it stopped; documents that failed are listed
+in the checkpoint and retried first on the next run. The API serves both
+layouts, so this can run while the backend is live.
+
+    python migrate_blobs.py --dry-run
+    python migrate_blobs.py --workers 8 --max-mb-per-sec 20
+    python migrate_blobs.py --collections floorplans --restart
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+from storage import blob_store_from_env, image_key, floorplan_key
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+logger = logging.getLogger("migrate_blobs")
+
+KEY_FUNCS = {"images": image_key, "floorplans": floorplan_key}
+CHUNK_SIZE = 1024 * 1024
+
+
+class RateLimiter:
+    """Thread-safe pacing to at most ``rate`` units per second (0 = unlimited)."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_at)
+            self.next_at = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class Checkpoint:
+    def __init__(self, path: Path, restart: bool):
+        self.path = path
+        self.state = {}
+        if path.exists() and not restart:
+            self.state = json.loads(path.read_text())
+
+    def last_id(self, collection: str):
+        last = self.state.get(collection, {}).get("last_id")
+        return ObjectId(last) if last else None
+
+    def failed(self, collection: str):
+        return self.state.setdefault(collection, {}).setdefault("failed", [])
+
+    def record_failed(self, collection: str, doc_id: str):
+        failed = self.failed(collection)
+        if doc_id not in failed:
+            failed.append(doc_id)
+
+    def clear_failed(self, collection: str, doc_ids):
+        done = set(doc_ids)
+        self.failed(collection)[:] = [i for i in self.failed(collection) if i not in done]
+        self.save()
+
+    def advance(self, collection: str, last_id: ObjectId, migrated: int, migrated_bytes: int):
+        entry = self.state.setdefault(collection, {})
+        entry["last_id"] = str(last_id)
+        entry["migrated"] = entry.get("migrated", 0) + migrated
+        entry["bytes"] = entry.get("bytes", 0) + migrated_bytes
+        self.save()
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.state, indent=2))
+        tmp.replace(self.path)
+
+
+class Migrator:
+    def __init__(self, db, store, args):
+        self.db = db
+        self.store = store
+        self.args = args
+        self.docs_limiter = RateLimiter(args.max_docs_per_sec)
+        self.bytes_limiter = RateLimiter(args.max_mb_per_sec * 1024 * 1024)
+
+    def verify(self, key: str, sha256: str):
+        digest = hashlib.sha256()
+        body = self.store.open(key)
+        for chunk in iter(lambda: body.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+        if digest.hexdigest() != sha256:
+            raise ValueError(f"hash mismatch for {key}")
+
+    def migrate_one(self, collection: str, doc: dict):
+        raw = base64.b64decode(doc["data"])
+        self.docs_limiter.acquire()
+        self.bytes_limiter.acquire(len(raw))
+        if self.args.dry_run:
+            return len(raw)
+
+        sha256 = hashlib.sha256(raw).hexdigest()
+        key = KEY_FUNCS[collection](doc["project_id"], doc["id"])
+        self.store.put(key, io.BytesIO(raw), doc.get("content_type") or "application/octet-stream",
+                       metadata={"sha256": sha256})
+        if self.args.verify:
+            self.verify(key, sha256)
+
+        blob = {"backend": self.store.backend, "key": key, "size": len(raw), "sha256": sha256}
+        result = self.db[collection].update_one(
+            {"_id": doc["_id"], "data": {"$exists": True}},
+            {"$set": {"blob": blob, "sha256": sha256}, "$unset": {"data": ""}}
+        )
+        if not result.matched_count:
+            # Deleted mid-run: drop the upload, unless another run already
+            # swapped the document over to this very key.
+            if not self.db[collection].count_documents({"_id": doc["_id"], "blob.key": key}, limit=1):
+                self.store.delete(key)
+            return 0
+        return len(raw)
+
+    def migrate_batch(self, collection: str, batch, pool: ThreadPoolExecutor):
+        futures = [(doc, pool.submit(self.migrate_one, collection, doc)) for doc in batch]
+        migrated_bytes, succeeded, failed = 0, [], []
+        for doc, future in futures:
+            try:
+                migrated_bytes += future.result()
+                succeeded.append(doc.get("id"))
+            except Exception as e:
+                logger.error("%s %s failed: %s", collection, doc.get("id"), e)
+                failed.append(doc.get("id"))
+        return migrated_bytes, succeeded, failed
+
+    def retry_failed(self, collection: str, checkpoint: Checkpoint, pool: ThreadPoolExecutor):
+        ids = list(checkpoint.failed(collection))
+        if not ids:
+            return 0
+        logger.info("%s: retrying %d documents that failed in an earlier run", collection, len(ids))
+        projection = {"_id": 1, "id": 1, "project_id": 1, "content_type": 1, "data": 1}
+        failed = []
+        for start in range(0, len(ids), self.args.batch_size):
+            chunk = ids[start:start + self.args.batch_size]
+            batch = list(self.db[collection].find({"id": {"$in": chunk}, "data": {"$exists": True}}, projection))
+            _, _, chunk_failed = self.migrate_batch(collection, batch, pool)
+            failed.extend(chunk_failed)
+        if not self.args.dry_run:
+            # Ids that are gone or no longer inline need no retry either.
+            checkpoint.clear_failed(collection, [i for i in ids if i not in failed])
+        return len(failed)
+
+    def run(self, collection: str, checkpoint: Checkpoint, pool: ThreadPoolExecutor):
+        query = {"data": {"$exists": True}}
+        last_id = checkpoint.last_id(collection)
+        if last_id:
+            query["_id"] = {"$gt": last_id}
+        total = self.db[collection].count_documents(query)
+        logger.info("%s: %d documents to migrate%s", collection, total, " (dry run)" if self.args.dry_run else "")
+
+        failed = self.retry_failed(collection, checkpoint, pool)
+        done = done_bytes = 0
+        started = time.monotonic()
+        projection = {"_id": 1, "id": 1, "project_id": 1, "content_type": 1, "data": 1}
+        while not self.args.limit or done < self.args.limit:
+            if last_id:
+                query["_id"] = {"$gt": last_id}
+            batch = list(self.db[collection].find(query, projection).sort("_id", 1).limit(self.args.batch_size))
+            if not batch:
+                break
+
+            migrated_bytes, succeeded, batch_failed = self.migrate_batch(collection, batch, pool)
+            migrated = len(succeeded)
+            failed += len(batch_failed)
+            for doc_id in batch_failed:
+                checkpoint.record_failed(collection, doc_id)
+
+            last_id = batch[-1]["_id"]
+            done += len(batch)
+            done_bytes += migrated_bytes
+            # Dry runs leave the checkpoint alone so the real run starts from scratch.
+            if not self.args.dry_run:
+                checkpoint.advance(collection, last_id, migrated, migrated_bytes)
+
+            elapsed = max(time.monotonic() - started, 1e-6)
+            rate = done / elapsed
+            eta = (total - done) / rate if rate else 0
+            logger.info("%s: %d/%d docs, %.1f MB, %.1f docs/s, %.2f MB/s, ETA %ds",
+                        collection, done, total, done_bytes / 1e6, rate, done_bytes / 1e6 / elapsed, eta)
+
+        logger.info("%s: finished, %d documents processed, %d failed this run", collection, done, failed)
+        return done, failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--collections", nargs="+", choices=list(KEY_FUNCS), default=list(KEY_FUNCS))
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-docs-per-sec", type=float, default=0, help="0 = unlimited")
+    parser.add_argument("--max-mb-per-sec", type=float, default=0, help="0 = unlimited")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many documents per collection")
+    parser.add_argument("--checkpoint", type=Path, default=ROOT_DIR / "migrate_blobs.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="skip read-back hash check")
+    parser.add_argument("--dry-run", action="store_true", help="decode and measure only, write nothing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    store = blob_store_from_env()
+    if store is None and not args.dry_run:
+        raise SystemExit("S3_BUCKET is not set; configure the blob store first")
+
+    client = MongoClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    checkpoint = Checkpoint(args.checkpoint, args.restart)
+    migrator = Migrator(db, store, args)
+
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for collection in args.collections:
+                failed += migrator.run(collection, checkpoint, pool)[1]
+    finally:
+        client.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,252 @@
+"""Opt-in per-request profiling: a sampling CPU profile plus a Mongo command trace.
+
+A request is profiled when it carries ``X-Profile: <PROFILE_TOKEN>`` or is
+picked by ``PROFILE_SAMPLE_RATE``. While it runs, a sampler thread records the
+event loop thread's stack every few milliseconds, and a pymongo command
+listener records every command issued from the request's context. Commands
+slower than ``PROFILE_SLOW_MS`` are explained after the response has been sent.
+Finished profiles go to a bounded ring buffer served by the admin endpoints.
+
+The event loop thread is shared, so samples taken while other requests are
+running include their frames too; profile on a quiet instance or read the
+stacks with that in mind. With neither trigger configured the middleware is
+a straight pass-through and the command listener is not registered at all.
+"""
+import asyncio
+import contextvars
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from bson import json_util
+from pymongo import monitoring
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+EXPLAINABLE = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# Session/cluster bookkeeping the server rejects inside an explain.
+STRIP_FIELDS = {"lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "autocommit", "startTransaction"}
+BULKY_FIELDS = {"documents", "updates", "deletes"}
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float, max_depth: int = 64):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Profile:
+    def __init__(self, scope, trigger: str, slow_ms: float):
+        self.slow_ms = slow_ms
+        self.started = time.perf_counter()
+        self.pending = {}
+        self.explains = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.record = {
+            "id": uuid.uuid4().hex[:12],
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope.get("query_string", b"").decode("latin-1"),
+            "trigger": trigger,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "mongo": [],
+            "slow_commands": [],
+        }
+
+    def command_started(self, event):
+        command = {k: v for k, v in event.command.items() if k not in STRIP_FIELDS}
+        with self.lock:
+            if self.closed:
+                return
+            self.pending[(event.request_id, event.connection_id)] = (event.database_name, command)
+
+    def command_finished(self, event, ok: bool):
+        with self.lock:
+            if self.closed:
+                return
+            database, command = self.pending.pop((event.request_id, event.connection_id), (None, {}))
+            duration_ms = event.duration_micros / 1000
+            target = command.get(event.command_name)
+            entry = {
+                "command": event.command_name,
+                "collection": target if isinstance(target, str) else None,
+                "duration_ms": round(duration_ms, 3),
+                "ok": ok,
+            }
+            self.record["mongo"].append(entry)
+            if duration_ms >= self.slow_ms and event.command_name in EXPLAINABLE:
+                summary = {k: (len(v) if k in BULKY_FIELDS else v) for k, v in command.items()}
+                slow = {**entry, "database": database, "summary": plain(summary)}
+                self.record["slow_commands"].append(slow)
+                self.explains.append((slow, database, command))
+
+
+def plain(doc):
+    # BSON types (ObjectId, Timestamp, bytes) as extended JSON, so records serialise as-is.
+    return json.loads(json_util.dumps(doc))
+
+
+class CommandTracer(monitoring.CommandListener):
+    def started(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.command_started(event)
+
+    def succeeded(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.command_finished(event, True)
+
+    def failed(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.command_finished(event, False)
+
+
+class Profiler:
+    def __init__(self, token: str = None, sample_rate: float = 0.0, slow_ms: float = 50.0,
+                 interval_ms: float = 5.0, buffer_size: int = 50, top_stacks: int = 50):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000
+        self.top_stacks = top_stacks
+        self.buffer = deque(maxlen=buffer_size)
+        self.tracer = CommandTracer()
+        self.client = None
+        self.tasks = set()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token) or self.sample_rate > 0
+
+    def event_listeners(self):
+        return [self.tracer] if self.enabled else []
+
+    def attach(self, client):
+        self.client = client
+
+    def trigger(self, scope):
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == b"x-profile" and hmac.compare_digest(value, self.token.encode()):
+                    return "header"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def is_admin(self, token: str) -> bool:
+        return bool(self.token) and token is not None and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def list(self):
+        keys = ("id", "method", "path", "query", "trigger", "started_at", "status", "duration_ms",
+                "samples", "mongo_count", "mongo_ms")
+        return [{k: p.get(k) for k in keys} for p in reversed(self.buffer)]
+
+    def get(self, profile_id: str):
+        return next((p for p in self.buffer if p["id"] == profile_id), None)
+
+    def finish(self, profile: Profile, sampler: StackSampler, status: int):
+        # Tasks spawned by the request (e.g. an archive job) inherit its
+        # context and keep issuing commands; stop recording them here.
+        with profile.lock:
+            profile.closed = True
+            profile.pending.clear()
+        record = profile.record
+        record["status"] = status
+        record["duration_ms"] = round((time.perf_counter() - profile.started) * 1000, 3)
+        record["samples"] = sampler.samples
+        record["interval_ms"] = self.interval * 1000
+        record["stacks"] = dict(sampler.stacks.most_common(self.top_stacks))
+        record["mongo_count"] = len(record["mongo"])
+        record["mongo_ms"] = round(sum(c["duration_ms"] for c in record["mongo"]), 3)
+        self.buffer.append(record)
+
+    def schedule_explains(self, profile: Profile):
+        if not profile.explains or self.client is None:
+            return
+        task = asyncio.create_task(self._explain(profile.explains))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _explain(self, explains):
+        # This task copied the request's context; don't trace our own explains.
+        current_profile.set(None)
+        for slow, database, command in explains:
+            try:
+                result = await self.client[database].command({"explain": command, "verbosity": "queryPlanner"})
+                slow["explain"] = plain(result.get("queryPlanner", result))
+            except Exception as e:
+                slow["explain_error"] = str(e)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.enabled:
+            return await self.app(scope, receive, send)
+        trigger = self.profiler.trigger(scope)
+        if trigger is None:
+            return await self.app(scope, receive, send)
+
+        profile = Profile(scope, trigger, self.profiler.slow_ms)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile.record["id"].encode())]
+            await send(message)
+
+        sampler = StackSampler(threading.get_ident(), self.profiler.interval)
+        token = current_profile.set(profile)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            current_profile.reset(token)
+            self.profiler.finish(profile, sampler, status["code"])
+            self.profiler.schedule_explains(profile)
+
+
+def profiler_from_env():
+    return Profiler(
+        token=os.environ.get("PROFILE_TOKEN") or None,
+        sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+        slow_ms=float(os.environ.get("PROFILE_SLOW_MS", "50")),
+        interval_ms=float(os.environ.get("PROFILE_INTERVAL_MS", "5")),
+        buffer_size=int(os.environ.get("PROFILE_BUFFER_SIZE", "50")),
+    )
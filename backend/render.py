@@ -0,0 +1,99 @@
+"""Server-side rendering of floorplans with their photo markers.
+
+``render_floorplan`` runs inside a process pool, so it only takes and returns
+plain bytes/lists and must not import anything from ``server``.
+"""
+import io
+from collections import OrderedDict
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # Pillow is optional; the render endpoint answers 501 without it
+    Image = None
+
+RENDER_AVAILABLE = Image is not None
+# What a broken or hostile plan raises: DecompressionBombError is not an
+# OSError, and encoders report size problems as ValueError.
+UNRENDERABLE = (OSError, ValueError, Image.DecompressionBombError) if RENDER_AVAILABLE else (OSError, ValueError)
+
+FORMATS = {"png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+MAX_SIDE = {"webp": 16383}
+CATEGORY_COLORS = {"alapszereles": "#f59e0b", "szerelvenyezes": "#2563eb", "atadas": "#16a34a"}
+DEFAULT_COLOR = "#f59e0b"
+
+
+def _font(size: int):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 has a single fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+def output_size(src_width: int, src_height: int, width: int, max_pixels: int, max_side: int = None):
+    """Scale to ``width``, narrower if needed to stay within ``max_pixels`` and ``max_side``."""
+    scale = min(width / src_width, (max_pixels / (src_width * src_height)) ** 0.5)
+    if max_side:
+        scale = min(scale, max_side / max(src_width, src_height))
+    return max(1, int(src_width * scale)), max(1, int(src_height * scale))
+
+
+def render_floorplan(data: bytes, markers: list, width: int, fmt: str, max_pixels: int) -> bytes:
+    """Draw ``markers`` (dicts with x/y in percent, label, color) on the plan scaled to ``width``."""
+    with Image.open(io.BytesIO(data)) as src:
+        plan = src.convert("RGB")
+    size = output_size(plan.width, plan.height, width, max_pixels, MAX_SIDE.get(fmt))
+    if size != plan.size:
+        plan = plan.resize(size, Image.LANCZOS)
+    width = plan.width
+
+    draw = ImageDraw.Draw(plan)
+    radius = max(8, width // 90)
+    font = _font(max(8, int(radius * 1.1)))
+    for marker in markers:
+        cx = marker["x"] / 100 * plan.width
+        cy = marker["y"] / 100 * plan.height
+        box = (cx - radius, cy - radius, cx + radius, cy + radius)
+        draw.ellipse(box, fill=marker["color"], outline="white", width=max(2, radius // 5))
+        if marker.get("label"):
+            left, top, right, bottom = draw.textbbox((0, 0), marker["label"], font=font)
+            draw.text((cx - (left + right) / 2, cy - (top + bottom) / 2), marker["label"], fill="white", font=font)
+
+    out = io.BytesIO()
+    plan.save(out, format=FORMATS[fmt][0])
+    return out.getvalue()
+
+
+class RenderCache:
+    """LRU of rendered images bounded by total bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.items[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self):
+        return {"entries": len(self.items), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
@@ -1,8 +1,17 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form
-from fastapi.responses import Response
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Request, Header
+from fastapi.responses import Response, JSONResponse, RedirectResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, IndexModel, ASCENDING, DESCENDING, ReadPreference
+from pymongo.errors import BulkWriteError, PyMongoError, DuplicateKeyError
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import hashlib
+import json
+import multiprocessing
 import os
 import logging
 from pathlib import Path
@@ -11,16 +20,75 @@ from typing import List, Optional
 import uuid
 from datetime import datetime, timezone
 import base64
+import time
+
+from admission import AdmissionMiddleware, admission_from_env
+from coldstore import cold_store_from_env, cold_key
+from ingest import IngestPool
+from profiling import ProfilingMiddleware, profiler_from_env
+from render import RENDER_AVAILABLE, UNRENDERABLE, FORMATS, CATEGORY_COLORS, DEFAULT_COLOR, RenderCache, render_floorplan
+from storage import blob_store_from_env, image_key, floorplan_key
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+DB_NAME = os.environ['DB_NAME']
 
-app = FastAPI()
-api_router = APIRouter(prefix="/api")
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+def mongo_client_options():
+    options = {
+        "appname": "baudok-backend",
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+        "socketTimeoutMS": int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", "30000")),
+    }
+    # zlib needs no extra package; snappy and zstd need python-snappy / zstandard.
+    compressors = os.environ.get("MONGO_COMPRESSORS", "")
+    if compressors:
+        options["compressors"] = compressors
+    return options
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", "3"))
+INGEST_RETRY_DELAY = float(os.environ.get("INGEST_RETRY_DELAY", "1"))
+
+S3_CREATE_BUCKET = os.environ.get("S3_CREATE_BUCKET", "").lower() in ("1", "true", "yes")
+S3_MAX_OBJECT_BYTES = int(os.environ.get("S3_MAX_OBJECT_BYTES", str(50 * 1024 * 1024)))
+
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "2"))
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_BYTES", str(128 * 1024 * 1024)))
+RENDER_MIN_WIDTH = 64
+RENDER_MAX_WIDTH = int(os.environ.get("RENDER_MAX_WIDTH", "4096"))
+# Bounds the output of narrow, tall plans, which would otherwise scale to huge heights.
+RENDER_MAX_PIXELS = int(os.environ.get("RENDER_MAX_PIXELS", str(4096 * 4096)))
+
+ARCHIVE_BUSY = ("archiving", "restoring")
+
+LIST_READ_PREFERENCE = os.environ.get("MONGO_LIST_READ_PREFERENCE", "primary")
+READY_PING_TIMEOUT = float(os.environ.get("READY_PING_TIMEOUT", "2"))
+
+# Set up in lifespan(); list endpoints read through list_db so they can be
+# routed to secondaries without affecting read-your-writes on the rest.
+client = None
+db = None
+list_db = None
+blob_store = None
+cold_store = None
+archive_tasks = {}
+render_pool = None
+render_cache = RenderCache(RENDER_CACHE_BYTES)
+app_state = {"ready": False}
 
 PREDEFINED_TAGS = [
     "villanyszerelés", "csövezés", "burkolás", "festés", 
@@ -28,6 +96,35 @@ PREDEFINED_TAGS = [
     "ablak", "ajtó", "fűtés", "klíma", "szaniter"
 ]
 
+CATEGORIES = ["alapszereles", "szerelvenyezes", "atadas"]
+
+INDEXES = {
+    "projects": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "images": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("project_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("project_id", ASCENDING), ("category", ASCENDING)]),
+        IndexModel([("project_id", ASCENDING), ("tags", ASCENDING)]),
+        IndexModel([("floorplan_id", ASCENDING)]),
+        IndexModel([("linked_image_id", ASCENDING)]),
+    ],
+    "image_uploads": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("project_id", ASCENDING)]),
+    ],
+    "floorplans": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("project_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+}
+
+FACET_CACHE_TTL = float(os.environ.get("FACET_CACHE_TTL", "60"))
+DATE_BUCKETS = {"day": 10, "month": 7, "year": 4}
+facet_cache = {}
+
 class ProjectCreate(BaseModel):
     name: str
     description: str = ""
@@ -45,6 +142,145 @@ class ImageUpdate(BaseModel):
     floorplan_x: Optional[float] = None
     floorplan_y: Optional[float] = None
 
+class ImagePresign(BaseModel):
+    filename: str = "image"
+    content_type: str = "image/jpeg"
+
+class ImageFinalize(BaseModel):
+    image_id: str
+    category: str
+    filename: str = "image"
+    description: str = ""
+    tags: List[str] = []
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    address: str = ""
+    floorplan_id: Optional[str] = None
+    floorplan_x: Optional[float] = None
+    floorplan_y: Optional[float] = None
+
+class ImageBulkItem(BaseModel):
+    id: str
+    description: Optional[str] = None
+    tags: Optional[List[str]] = None
+    add_tags: Optional[List[str]] = None
+    remove_tags: Optional[List[str]] = None
+    location: Optional[dict] = None
+    linked_image_id: Optional[str] = None
+    floorplan_id: Optional[str] = None
+    floorplan_x: Optional[float] = None
+    floorplan_y: Optional[float] = None
+
+class ImageBulkUpdate(BaseModel):
+    items: List[ImageBulkItem]
+
+BULK_MAX_ITEMS = 500
+
+async def ensure_indexes():
+    for collection, indexes in INDEXES.items():
+        await db[collection].create_indexes(indexes)
+
+async def ensure_bucket():
+    # The blob store only backs the presigned routes, so an unreachable bucket
+    # must not hold back readiness; keep trying in the background instead.
+    delay = 1
+    while True:
+        try:
+            await asyncio.to_thread(blob_store.ensure_bucket)
+            logger.info("Blob store bucket ready")
+            return
+        except Exception as e:
+            logger.warning("Blob store not reachable yet, retrying in %.0fs: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+async def warm_connections():
+    await client.admin.command("ping")
+    # Concurrent pings check out that many pool connections up front.
+    warm = max(client.options.pool_options.min_pool_size, 1)
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(warm)))
+    logger.info("MongoDB reachable (%d warm connections)", warm)
+
+async def warm_up():
+    # Each step is retried until it succeeds and then never run again, so a
+    # failure shows up in the log and keeps readiness at 503 with the reason,
+    # and recovery does not queue pending uploads twice.
+    steps = [warm_connections, ensure_indexes, ingest_pool.recover, resume_archive_jobs]
+    delay = 0.5
+    while steps:
+        try:
+            await steps[0]()
+            steps.pop(0)
+            continue
+        except PyMongoError as e:
+            logger.warning("MongoDB not ready yet (%s), retrying in %.1fs: %s", steps[0].__name__, delay, e)
+            app_state["error"] = str(e)
+        except Exception as e:
+            logger.exception("Warm-up step %s failed, retrying in %.1fs", steps[0].__name__, delay)
+            app_state["error"] = str(e)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 10)
+
+    app_state["ready"] = True
+    app_state.pop("error", None)
+    logger.info("Backend ready")
+
+def new_render_pool():
+    # spawn, not fork: the parent already runs Motor's executor threads.
+    return ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db, list_db, blob_store, cold_store, render_pool
+    client = AsyncIOMotorClient(mongo_url, event_listeners=profiler.event_listeners(), **mongo_client_options())
+    profiler.attach(client)
+    db = client[DB_NAME]
+    list_db = client.get_database(DB_NAME, read_preference=READ_PREFERENCES[LIST_READ_PREFERENCE])
+    blob_store = blob_store_from_env()
+    cold_store = cold_store_from_env()
+    render_pool = new_render_pool()
+    ingest_pool.start(db)
+    startup_tasks = [asyncio.create_task(warm_up())]
+    if blob_store and S3_CREATE_BUCKET:
+        startup_tasks.append(asyncio.create_task(ensure_bucket()))
+    try:
+        yield
+    finally:
+        for task in startup_tasks:
+            task.cancel()
+        app_state["ready"] = False
+        await ingest_pool.stop()
+        for task in list(archive_tasks.values()):
+            task.cancel()
+        render_pool.shutdown(wait=False, cancel_futures=True)
+        client.close()
+
+app = FastAPI(lifespan=lifespan)
+api_router = APIRouter(prefix="/api")
+logger = logging.getLogger(__name__)
+
+async def refresh_image_count(project_id: str):
+    count = await db.images.count_documents({"project_id": project_id})
+    await db.projects.update_one({"id": project_id}, {"$set": {"image_count": count, "updated_at": now_iso()}})
+    invalidate_facets(project_id)
+
+admission, admission_options = admission_from_env()
+profiler = profiler_from_env()
+
+ingest_pool = IngestPool(
+    workers=INGEST_WORKERS,
+    max_attempts=INGEST_MAX_ATTEMPTS,
+    retry_delay=INGEST_RETRY_DELAY,
+    on_ready=refresh_image_count
+)
+
+def invalidate_facets(project_id: Optional[str] = None):
+    if project_id is None:
+        facet_cache.clear()
+        return
+    for key in [k for k in facet_cache if k[0] == project_id]:
+        facet_cache.pop(key, None)
+
 def create_id():
     return str(uuid.uuid4())
 
@@ -55,6 +291,48 @@ def now_iso():
 async def root():
     return {"message": "BauDok API"}
 
+@api_router.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    if not app_state["ready"]:
+        content = {"status": "starting"}
+        if "error" in app_state:
+            content["error"] = app_state["error"]
+        return JSONResponse(status_code=503, content=content)
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), READY_PING_TIMEOUT)
+    except (PyMongoError, asyncio.TimeoutError):
+        return JSONResponse(status_code=503, content={"status": "unavailable"})
+    return {"status": "ready"}
+
+@api_router.get("/metrics/cold")
+async def get_cold_metrics():
+    return cold_store.stats() if cold_store else {"enabled": False}
+
+@api_router.get("/metrics/admission")
+async def get_admission_metrics():
+    return admission.snapshot()
+
+def require_admin(token: Optional[str]):
+    if not profiler.is_admin(token):
+        raise HTTPException(status_code=403, detail="Hozzáférés megtagadva")
+
+@api_router.get("/admin/profiles")
+async def get_profiles(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    return profiler.list()
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    profile = profiler.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profil nem található")
+    return profile
+
 @api_router.get("/tags")
 async def get_tags():
     return {"tags": PREDEFINED_TAGS}
@@ -78,7 +356,7 @@ async def get_projects(search: Optional[str] = None):
     query = {}
     if search:
         query["name"] = {"$regex": search, "$options": "i"}
-    cursor = db.projects.find(query, {"_id": 0}).sort("created_at", -1)
+    cursor = list_db.projects.find(query, {"_id": 0}).sort("created_at", -1)
     return await cursor.to_list(1000)
 
 @api_router.get("/projects/{project_id}")
@@ -87,11 +365,11 @@ async def get_project(project_id: str):
     if not project:
         raise HTTPException(status_code=404, detail="Projekt nem található")
     
-    images = await db.images.find({"project_id": project_id}, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(1000)
-    floorplans = await db.floorplans.find({"project_id": project_id}, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(100)
+    images = await list_db.images.find({"project_id": project_id}, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(1000)
+    floorplans = await list_db.floorplans.find({"project_id": project_id}, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(100)
     
     for fp in floorplans:
-        fp["marker_count"] = await db.images.count_documents({"floorplan_id": fp["id"]})
+        fp["marker_count"] = await list_db.images.count_documents({"floorplan_id": fp["id"]})
     
     return {**project, "images": images, "floorplans": floorplans}
 
@@ -115,8 +393,22 @@ async def delete_project(project_id: str):
         raise HTTPException(status_code=404, detail="Projekt nem található")
     
     await db.images.delete_many({"project_id": project_id})
+    await db.image_uploads.delete_many({"project_id": project_id})
+    if blob_store:
+        try:
+            await asyncio.to_thread(blob_store.delete_prefix, image_key(project_id, ""))
+            await asyncio.to_thread(blob_store.delete_prefix, floorplan_key(project_id, ""))
+        except Exception:
+            logger.exception("Could not delete blobs for project %s", project_id)
+    if cold_store:
+        try:
+            for collection in ("images", "floorplans"):
+                await asyncio.to_thread(cold_store.delete_prefix, cold_key(collection, project_id))
+        except Exception:
+            logger.exception("Could not delete blobs for project %s", project_id)
     await db.floorplans.delete_many({"project_id": project_id})
     await db.projects.delete_one({"id": project_id})
+    invalidate_facets(project_id)
     return {"message": "Projekt törölve"}
 
 @api_router.post("/projects/{project_id}/floorplans")
@@ -137,6 +429,7 @@ async def upload_floorplan(
         "filename": file.filename or "floorplan",
         "content_type": file.content_type or "image/jpeg",
         "data": base64.b64encode(content).decode('utf-8'),
+        "sha256": hashlib.sha256(content).hexdigest(),
         "created_at": now_iso()
     }
     await db.floorplans.insert_one(floorplan)
@@ -153,9 +446,9 @@ async def upload_floorplan(
 
 @api_router.get("/projects/{project_id}/floorplans")
 async def get_floorplans(project_id: str):
-    floorplans = await db.floorplans.find({"project_id": project_id}, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(100)
+    floorplans = await list_db.floorplans.find({"project_id": project_id}, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(100)
     for fp in floorplans:
-        fp["marker_count"] = await db.images.count_documents({"floorplan_id": fp["id"]})
+        fp["marker_count"] = await list_db.images.count_documents({"floorplan_id": fp["id"]})
     return floorplans
 
 @api_router.get("/floorplans/{floorplan_id}/data")
@@ -163,14 +456,107 @@ async def get_floorplan_data(floorplan_id: str):
     floorplan = await db.floorplans.find_one({"id": floorplan_id})
     if not floorplan:
         raise HTTPException(status_code=404, detail="Tervrajz nem található")
-    data = base64.b64decode(floorplan["data"])
+    if "blob" in floorplan:
+        return blob_redirect(floorplan)
+    if "cold" in floorplan:
+        data = await fetch_cold(floorplan)
+    else:
+        data = base64.b64decode(floorplan["data"])
     return Response(content=data, media_type=floorplan.get("content_type", "image/jpeg"))
 
 @api_router.get("/floorplans/{floorplan_id}/images")
 async def get_floorplan_images(floorplan_id: str):
-    images = await db.images.find({"floorplan_id": floorplan_id}, {"_id": 0, "data": 0}).to_list(1000)
+    images = await list_db.images.find({"floorplan_id": floorplan_id}, {"_id": 0, "data": 0}).to_list(1000)
     return images
 
+async def load_floorplan_bytes(floorplan_id: str):
+    floorplan = await db.floorplans.find_one({"id": floorplan_id}, {"_id": 0, "data": 1, "blob": 1, "cold": 1})
+    if "blob" in floorplan:
+        return await asyncio.to_thread(require_blob_store().get, floorplan["blob"]["key"])
+    if "cold" in floorplan:
+        return await fetch_cold(floorplan)
+    return base64.b64decode(floorplan["data"])
+
+async def run_render(data: bytes, markers: list, width: int, fmt: str):
+    global render_pool
+    pool = render_pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, render_floorplan, data, markers, width, fmt, RENDER_MAX_PIXELS)
+    except UNRENDERABLE:
+        raise HTTPException(status_code=422, detail="A tervrajz nem renderelhető")
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed) and the pool refuses all further work;
+        # swap in a fresh one unless a concurrent request already did.
+        if render_pool is pool:
+            logger.error("Render worker died, restarting the render pool")
+            render_pool = new_render_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(status_code=503, detail="Renderelés átmenetileg nem elérhető")
+
+@api_router.get("/floorplans/{floorplan_id}/render")
+async def render_floorplan_markers(
+    floorplan_id: str,
+    request: Request,
+    width: int = 1200,
+    format: str = "png",
+    style: str = "numbered"
+):
+    if not RENDER_AVAILABLE:
+        raise HTTPException(status_code=501, detail="Renderelés nem elérhető")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail="Érvénytelen formátum")
+    if style not in ("numbered", "category"):
+        raise HTTPException(status_code=400, detail="Érvénytelen jelölőstílus")
+    if not RENDER_MIN_WIDTH <= width <= RENDER_MAX_WIDTH:
+        raise HTTPException(status_code=400, detail="Érvénytelen szélesség")
+    
+    floorplan = await db.floorplans.find_one({"id": floorplan_id}, {"_id": 0, "sha256": 1, "blob": 1, "cold": 1})
+    if not floorplan:
+        raise HTTPException(status_code=404, detail="Tervrajz nem található")
+    
+    images = await list_db.images.find(
+        {"floorplan_id": floorplan_id, "floorplan_x": {"$ne": None}, "floorplan_y": {"$ne": None}},
+        {"_id": 0, "id": 1, "category": 1, "floorplan_x": 1, "floorplan_y": 1, "created_at": 1}
+    ).sort("created_at", 1).to_list(1000)
+    # The marker set version is derived from the markers themselves, so the
+    # cache only misses when a marker is added, moved, recategorised or removed.
+    marker_version = hashlib.sha256(json.dumps(
+        [[i["id"], i["floorplan_x"], i["floorplan_y"], i.get("category")] for i in images]
+    ).encode()).hexdigest()[:16]
+    
+    data = None
+    plan_hash = floorplan.get("sha256") or floorplan.get("blob", {}).get("sha256") or floorplan.get("cold", {}).get("sha256")
+    if not plan_hash:
+        data = await load_floorplan_bytes(floorplan_id)
+        plan_hash = hashlib.sha256(data).hexdigest()
+        await db.floorplans.update_one({"id": floorplan_id}, {"$set": {"sha256": plan_hash}})
+    
+    key = f"{plan_hash}:{marker_version}:{width}:{format}:{style}"
+    etag = '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    rendered = render_cache.get(key)
+    if rendered is None:
+        if data is None:
+            data = await load_floorplan_bytes(floorplan_id)
+        markers = [{
+            "x": img["floorplan_x"],
+            "y": img["floorplan_y"],
+            "label": str(n) if style == "numbered" else "",
+            "color": DEFAULT_COLOR if style == "numbered" else CATEGORY_COLORS.get(img.get("category"), DEFAULT_COLOR)
+        } for n, img in enumerate(images, start=1)]
+        rendered = await run_render(data, markers, width, format)
+        render_cache.put(key, rendered)
+    
+    return Response(content=rendered, media_type=FORMATS[format][1], headers=headers)
+
+@api_router.get("/metrics/render")
+async def get_render_metrics():
+    return render_cache.stats()
+
 @api_router.delete("/floorplans/{floorplan_id}")
 async def delete_floorplan(floorplan_id: str):
     floorplan = await db.floorplans.find_one({"id": floorplan_id})
@@ -182,8 +568,40 @@ async def delete_floorplan(floorplan_id: str):
         {"$set": {"floorplan_id": None, "floorplan_x": None, "floorplan_y": None}}
     )
     await db.floorplans.delete_one({"id": floorplan_id})
+    await delete_blob(floorplan)
+    invalidate_facets(floorplan["project_id"])
     return {"message": "Tervrajz törölve"}
 
+async def check_image_upload(project_id: str, category: str):
+    project = await db.projects.find_one({"id": project_id}, {"_id": 0, "id": 1})
+    if not project:
+        raise HTTPException(status_code=404, detail="Projekt nem található")
+    
+    if category not in CATEGORIES:
+        raise HTTPException(status_code=400, detail="Érvénytelen kategória")
+
+def parse_tags(tags: str):
+    return [t.strip() for t in tags.split(",") if t.strip()] if tags else []
+
+def new_image_doc(project_id, filename, content_type, category, description, tag_list, lat, lng, address,
+                  floorplan_id, floorplan_x, floorplan_y, image_id=None):
+    location = {"lat": lat, "lng": lng, "address": address} if lat and lng else None
+    return {
+        "id": image_id or create_id(),
+        "project_id": project_id,
+        "category": category,
+        "description": description,
+        "filename": filename or "image",
+        "content_type": content_type or "image/jpeg",
+        "tags": tag_list,
+        "location": location,
+        "linked_image_id": None,
+        "floorplan_id": floorplan_id if floorplan_id else None,
+        "floorplan_x": floorplan_x,
+        "floorplan_y": floorplan_y,
+        "created_at": now_iso()
+    }
+
 @api_router.post("/projects/{project_id}/images")
 async def upload_image(
     project_id: str,
@@ -198,42 +616,229 @@ async def upload_image(
     floorplan_x: Optional[float] = Form(None),
     floorplan_y: Optional[float] = Form(None)
 ):
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Projekt nem található")
-    
-    if category not in ["alapszereles", "szerelvenyezes", "atadas"]:
-        raise HTTPException(status_code=400, detail="Érvénytelen kategória")
+    await check_image_upload(project_id, category)
     
     content = await file.read()
-    tag_list = [t.strip() for t in tags.split(",") if t.strip()] if tags else []
-    location = {"lat": lat, "lng": lng, "address": address} if lat and lng else None
+    image = new_image_doc(project_id, file.filename, file.content_type, category, description, parse_tags(tags),
+                          lat, lng, address, floorplan_id, floorplan_x, floorplan_y)
+    image["data"] = base64.b64encode(content).decode('utf-8')
+    await db.images.insert_one(image)
     
-    image = {
-        "id": create_id(),
+    await refresh_image_count(project_id)
+    
+    image.pop("data", None)
+    image.pop("_id", None)
+    return image
+
+@api_router.post("/projects/{project_id}/images/ingest", status_code=202)
+async def ingest_image(
+    project_id: str,
+    file: UploadFile = File(...),
+    category: str = Form(...),
+    description: str = Form(""),
+    tags: str = Form(""),
+    lat: Optional[float] = Form(None),
+    lng: Optional[float] = Form(None),
+    address: str = Form(""),
+    floorplan_id: Optional[str] = Form(None),
+    floorplan_x: Optional[float] = Form(None),
+    floorplan_y: Optional[float] = Form(None)
+):
+    await check_image_upload(project_id, category)
+    
+    content = await file.read()
+    image = new_image_doc(project_id, file.filename, file.content_type, category, description, parse_tags(tags),
+                          lat, lng, address, floorplan_id, floorplan_x, floorplan_y)
+    image["status"] = "processing"
+    image["attempts"] = 0
+    # Raw bytes go in as BSON binary; encoding and the rest happen in the worker.
+    await db.image_uploads.insert_one({
+        "id": image["id"],
         "project_id": project_id,
-        "category": category,
-        "description": description,
-        "filename": file.filename or "image",
-        "content_type": file.content_type or "image/jpeg",
-        "data": base64.b64encode(content).decode('utf-8'),
-        "tags": tag_list,
-        "location": location,
-        "linked_image_id": None,
-        "floorplan_id": floorplan_id if floorplan_id else None,
-        "floorplan_x": floorplan_x,
-        "floorplan_y": floorplan_y,
-        "created_at": now_iso()
-    }
+        "raw": content,
+        "attempts": 0,
+        "created_at": image["created_at"]
+    })
     await db.images.insert_one(image)
+    ingest_pool.submit(image["id"])
+    invalidate_facets(project_id)
     
-    count = await db.images.count_documents({"project_id": project_id})
-    await db.projects.update_one({"id": project_id}, {"$set": {"image_count": count, "updated_at": now_iso()}})
+    image.pop("_id", None)
+    return image
+
+def require_blob_store():
+    if blob_store is None:
+        raise HTTPException(status_code=503, detail="Objektumtár nincs beállítva")
+    return blob_store
+
+def blob_redirect(doc: dict):
+    store = require_blob_store()
+    url = store.presign_get(doc["blob"]["key"], doc.get("content_type"))
+    # Let browsers reuse the redirect, but never past the URL's expiry.
+    max_age = min(60, store.presign_expires // 2)
+    return RedirectResponse(url, status_code=307, headers={"Cache-Control": f"private, max-age={max_age}"})
+
+async def delete_blob(doc: dict):
+    try:
+        if "blob" in doc and blob_store:
+            await asyncio.to_thread(blob_store.delete, doc["blob"]["key"])
+        if "cold" in doc and cold_store:
+            await asyncio.to_thread(cold_store.delete, doc["cold"])
+    except Exception:
+        logger.exception("Could not delete stored bytes for %s", doc.get("id"))
+
+def require_cold_store():
+    if cold_store is None:
+        raise HTTPException(status_code=503, detail="Archív tároló nincs beállítva")
+    return cold_store
+
+async def fetch_cold(doc: dict):
+    return await asyncio.to_thread(require_cold_store().fetch, doc["cold"])
+
+async def run_archive(project_id: str, restore: bool):
+    done_state = "active" if restore else "archived"
+    try:
+        for collection in ("images", "floorplans"):
+            if restore:
+                query = {"project_id": project_id, "cold": {"$exists": True}}
+                projection = {"_id": 1, "id": 1, "cold": 1}
+            else:
+                query = {"project_id": project_id, "data": {"$exists": True}}
+                projection = {"_id": 1, "id": 1, "data": 1}
+            # Small batches keep only a handful of payloads in memory at once.
+            async for doc in db[collection].find(query, projection).batch_size(10):
+                if restore:
+                    raw = await asyncio.to_thread(cold_store.fetch, doc["cold"])
+                    await db[collection].update_one(
+                        {"_id": doc["_id"], "cold": {"$exists": True}},
+                        {"$set": {"data": base64.b64encode(raw).decode('utf-8')}, "$unset": {"cold": ""}}
+                    )
+                    await asyncio.to_thread(cold_store.delete, doc["cold"])
+                else:
+                    raw = base64.b64decode(doc["data"])
+                    ref = await asyncio.to_thread(cold_store.put, cold_key(collection, project_id, doc["id"]), raw)
+                    await db[collection].update_one(
+                        {"_id": doc["_id"], "data": {"$exists": True}},
+                        {"$set": {"cold": ref, "sha256": ref["sha256"]}, "$unset": {"data": ""}}
+                    )
+        await db.projects.update_one(
+            {"id": project_id},
+            {"$set": {"archive_state": done_state, "archived": not restore, "archived_at": None if restore else now_iso()},
+             "$unset": {"archive_error": ""}}
+        )
+    except asyncio.CancelledError:
+        logger.warning("Archive job for project %s interrupted, it resumes on next start", project_id)
+        raise
+    except Exception as e:
+        logger.exception("Archive job for project %s failed", project_id)
+        await db.projects.update_one({"id": project_id}, {"$set": {"archive_state": "failed", "archive_error": str(e)}})
+
+async def start_archive_job(project_id: str, restore: bool):
+    require_cold_store()
+    state = "restoring" if restore else "archiving"
+    project = await db.projects.find_one_and_update(
+        {"id": project_id, "archive_state": {"$nin": ARCHIVE_BUSY}},
+        {"$set": {"archive_state": state}},
+        projection={"_id": 0, "id": 1}
+    )
+    if not project:
+        if await db.projects.find_one({"id": project_id}, {"_id": 0, "id": 1}):
+            raise HTTPException(status_code=409, detail="Archiválás folyamatban")
+        raise HTTPException(status_code=404, detail="Projekt nem található")
+    
+    spawn_archive_job(project_id, restore)
+    return {"id": project_id, "archive_state": state}
+
+def spawn_archive_job(project_id: str, restore: bool):
+    if project_id in archive_tasks:
+        return
+    task = asyncio.create_task(run_archive(project_id, restore))
+    archive_tasks[project_id] = task
+    task.add_done_callback(lambda _: archive_tasks.pop(project_id, None))
+
+async def resume_archive_jobs():
+    # Jobs run in-process, so a restart leaves their projects "archiving" or
+    # "restoring". Every step is conditional on the document's current
+    # layout, so picking the job up again is safe.
+    async for project in db.projects.find({"archive_state": {"$in": ARCHIVE_BUSY}}, {"_id": 0, "id": 1, "archive_state": 1}):
+        if cold_store is None:
+            await db.projects.update_one(
+                {"id": project["id"]},
+                {"$set": {"archive_state": "failed", "archive_error": "Archív tároló nincs beállítva"}}
+            )
+            continue
+        logger.info("Resuming interrupted archive job for project %s", project["id"])
+        spawn_archive_job(project["id"], restore=project["archive_state"] == "restoring")
+
+@api_router.post("/projects/{project_id}/archive", status_code=202)
+async def archive_project(project_id: str):
+    return await start_archive_job(project_id, restore=False)
+
+@api_router.post("/projects/{project_id}/restore", status_code=202)
+async def restore_project(project_id: str):
+    return await start_archive_job(project_id, restore=True)
+
+@api_router.post("/projects/{project_id}/images/presign")
+async def presign_image_upload(project_id: str, data: ImagePresign):
+    store = require_blob_store()
+    project = await db.projects.find_one({"id": project_id}, {"_id": 0, "id": 1})
+    if not project:
+        raise HTTPException(status_code=404, detail="Projekt nem található")
+    
+    image_id = create_id()
+    key = image_key(project_id, image_id)
+    return {
+        "image_id": image_id,
+        "key": key,
+        "method": "PUT",
+        "upload_url": store.presign_put(key, data.content_type),
+        "headers": {"Content-Type": data.content_type},
+        "expires_in": store.presign_expires
+    }
+
+@api_router.post("/projects/{project_id}/images/finalize")
+async def finalize_image_upload(project_id: str, data: ImageFinalize):
+    store = require_blob_store()
+    await check_image_upload(project_id, data.category)
+    
+    key = image_key(project_id, data.image_id)
+    head = await asyncio.to_thread(store.head, key)
+    if not head:
+        raise HTTPException(status_code=400, detail="A feltöltött fájl nem található")
+    if head["size"] > S3_MAX_OBJECT_BYTES:
+        await asyncio.to_thread(store.delete, key)
+        raise HTTPException(status_code=413, detail="A fájl túl nagy")
+    
+    image = new_image_doc(project_id, data.filename, head["content_type"], data.category, data.description,
+                          data.tags, data.lat, data.lng, data.address, data.floorplan_id, data.floorplan_x,
+                          data.floorplan_y, image_id=data.image_id)
+    image["blob"] = {"backend": store.backend, "key": key, "size": head["size"]}
+    try:
+        await db.images.insert_one(image)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="A kép már rögzítve van")
+    
+    await refresh_image_count(project_id)
     
-    image.pop("data", None)
     image.pop("_id", None)
     return image
 
+@api_router.get("/images/{image_id}/status")
+async def get_image_status(image_id: str):
+    image = await db.images.find_one({"id": image_id}, {"_id": 0, "status": 1, "attempts": 1, "error": 1})
+    if not image:
+        raise HTTPException(status_code=404, detail="Kép nem található")
+    return {
+        "id": image_id,
+        "status": image.get("status", "ready"),
+        "attempts": image.get("attempts", 0),
+        "error": image.get("error")
+    }
+
+@api_router.get("/ingest/stats")
+async def get_ingest_stats():
+    return {**ingest_pool.stats(), "pending": await db.image_uploads.count_documents({"failed": {"$ne": True}})}
+
 @api_router.get("/projects/{project_id}/images")
 async def get_project_images(
     project_id: str,
@@ -246,20 +851,164 @@ async def get_project_images(
     if tag:
         query["tags"] = tag
     
-    images = await db.images.find(query, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(1000)
+    images = await list_db.images.find(query, {"_id": 0, "data": 0}).sort("created_at", -1).to_list(1000)
     return images
 
+@api_router.get("/projects/{project_id}/images/facets")
+async def get_image_facets(project_id: str, bucket: str = "day"):
+    if bucket not in DATE_BUCKETS:
+        raise HTTPException(status_code=400, detail="Érvénytelen dátum csoportosítás")
+
+    key = (project_id, bucket)
+    cached = facet_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    def count_by(field):
+        return [{"$group": {"_id": field, "count": {"$sum": 1}}}, {"$sort": {"count": -1, "_id": 1}}]
+
+    pipeline = [
+        {"$match": {"project_id": project_id}},
+        {"$project": {"_id": 0, "category": 1, "tags": 1, "floorplan_id": 1, "created_at": 1}},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "category": count_by("$category"),
+            "tag": [{"$unwind": "$tags"}] + count_by("$tags"),
+            "floorplan": [{"$match": {"floorplan_id": {"$ne": None}}}] + count_by("$floorplan_id"),
+            "date": [
+                {"$group": {"_id": {"$substrBytes": ["$created_at", 0, DATE_BUCKETS[bucket]]}, "count": {"$sum": 1}}},
+                {"$sort": {"_id": -1}}
+            ]
+        }}
+    ]
+    result = (await list_db.images.aggregate(pipeline).to_list(1))[0]
+
+    def counts(rows, defaults=()):
+        found = {r["_id"]: r["count"] for r in rows}
+        return {**{d: 0 for d in defaults}, **found}
+
+    facets = {
+        "project_id": project_id,
+        "total": result["total"][0]["count"] if result["total"] else 0,
+        "category": counts(result["category"], CATEGORIES),
+        "tag": counts(result["tag"], PREDEFINED_TAGS),
+        "floorplan": counts(result["floorplan"]),
+        "date": [{"bucket": r["_id"], "count": r["count"]} for r in result["date"]]
+    }
+    facet_cache[key] = (time.monotonic() + FACET_CACHE_TTL, facets)
+    return facets
+
 @api_router.get("/images/{image_id}/data")
 async def get_image_data(image_id: str):
     image = await db.images.find_one({"id": image_id})
     if not image:
         raise HTTPException(status_code=404, detail="Kép nem található")
-    data = base64.b64decode(image["data"])
+    if image.get("status") == "processing":
+        raise HTTPException(status_code=409, detail="Kép feldolgozás alatt")
+    if image.get("status") == "failed":
+        raise HTTPException(status_code=409, detail="Kép feldolgozása sikertelen")
+    if "blob" in image:
+        return blob_redirect(image)
+    if "cold" in image:
+        data = await fetch_cold(image)
+    else:
+        data = base64.b64decode(image["data"])
     return Response(content=data, media_type=image.get("content_type", "image/jpeg"))
 
+def bulk_image_update(item: ImageBulkItem):
+    # Plain $set when possible; tag add/remove needs a pipeline update because
+    # $addToSet and $pull may not target the same field in one operation.
+    update = {}
+    if item.description is not None:
+        update["description"] = item.description
+    if item.location is not None:
+        update["location"] = item.location
+    if item.linked_image_id is not None:
+        update["linked_image_id"] = item.linked_image_id if item.linked_image_id else None
+    if item.floorplan_id is not None:
+        update["floorplan_id"] = item.floorplan_id if item.floorplan_id else None
+        if not item.floorplan_id:
+            update["floorplan_x"] = None
+            update["floorplan_y"] = None
+    if item.floorplan_x is not None and item.floorplan_id != "":
+        update["floorplan_x"] = item.floorplan_x
+    if item.floorplan_y is not None and item.floorplan_id != "":
+        update["floorplan_y"] = item.floorplan_y
+
+    add_tags = list(dict.fromkeys(item.add_tags or []))
+    remove_tags = list(dict.fromkeys(item.remove_tags or []))
+    if not add_tags and not remove_tags:
+        if item.tags is not None:
+            update["tags"] = item.tags
+        return {"$set": update} if update else None
+
+    base = {"$literal": item.tags} if item.tags is not None else {"$ifNull": ["$tags", []]}
+    kept = {"$filter": {"input": base, "cond": {"$not": [{"$in": ["$$this", {"$literal": remove_tags}]}]}}}
+    added = {"$filter": {
+        "input": {"$literal": [t for t in add_tags if t not in remove_tags]},
+        "cond": {"$not": [{"$in": ["$$this", base]}]}
+    }}
+    stage = {k: {"$literal": v} for k, v in update.items()}
+    stage["tags"] = {"$concatArrays": [kept, added]}
+    return [{"$set": stage}]
+
+@api_router.post("/images/bulk")
+async def bulk_update_images(data: ImageBulkUpdate):
+    if not data.items:
+        raise HTTPException(status_code=400, detail="Üres kérés")
+    if len(data.items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Legfeljebb {BULK_MAX_ITEMS} kép frissíthető egyszerre")
+
+    results = [{"id": item.id, "status": "unchanged"} for item in data.items]
+    ops, op_index = [], []
+    for i, item in enumerate(data.items):
+        update = bulk_image_update(item)
+        if update is not None:
+            ops.append(UpdateOne({"id": item.id}, update))
+            op_index.append(i)
+
+    if not ops:
+        return {"matched": 0, "modified": 0, "failed": 0, "results": results}
+
+    try:
+        result = await db.images.bulk_write(ops, ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+    # Items carry no project id and we don't pre-read, so drop every entry.
+    invalidate_facets()
+
+    failed = set()
+    for err in details.get("writeErrors", []):
+        i = op_index[err["index"]]
+        failed.add(i)
+        results[i] = {"id": data.items[i].id, "status": "error", "error": err.get("errmsg", "")}
+
+    # bulk_write only reports totals, so per item we can tell "its filter
+    # matched" (possibly a no-op) apart from "not_found", not what changed.
+    attempted = [i for i in op_index if i not in failed]
+    for i in attempted:
+        results[i]["status"] = "matched"
+
+    # Only when some filter matched nothing do we look up which ids exist,
+    # and then just the ids through the index.
+    if details.get("nMatched", 0) < len(attempted):
+        ids = list({data.items[i].id for i in attempted})
+        found = {d["id"] for d in await db.images.find({"id": {"$in": ids}}, {"_id": 0, "id": 1}).to_list(len(ids))}
+        for i in attempted:
+            if data.items[i].id not in found:
+                results[i]["status"] = "not_found"
+
+    return {
+        "matched": details.get("nMatched", 0),
+        "modified": details.get("nModified", 0),
+        "failed": len(failed),
+        "results": results
+    }
+
 @api_router.put("/images/{image_id}")
 async def update_image(image_id: str, data: ImageUpdate):
-    image = await db.images.find_one({"id": image_id})
+    image = await db.images.find_one({"id": image_id}, {"_id": 0, "project_id": 1})
     if not image:
         raise HTTPException(status_code=404, detail="Kép nem található")
     
@@ -281,6 +1030,7 @@ async def update_image(image_id: str, data: ImageUpdate):
     
     if update:
         await db.images.update_one({"id": image_id}, {"$set": update})
+        invalidate_facets(image["project_id"])
     return {"message": "Kép frissítve"}
 
 @api_router.delete("/images/{image_id}")
@@ -292,13 +1042,17 @@ async def delete_image(image_id: str):
     project_id = image["project_id"]
     await db.images.update_many({"linked_image_id": image_id}, {"$set": {"linked_image_id": None}})
     await db.images.delete_one({"id": image_id})
+    await db.image_uploads.delete_one({"id": image_id})
+    await delete_blob(image)
     
-    count = await db.images.count_documents({"project_id": project_id})
-    await db.projects.update_one({"id": project_id}, {"$set": {"image_count": count, "updated_at": now_iso()}})
+    await refresh_image_count(project_id)
     return {"message": "Kép törölve"}
 
 app.include_router(api_router)
 
+# Added before CORS so rejections still carry CORS headers.
+app.add_middleware(AdmissionMiddleware, controller=admission, **admission_options)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -307,8 +1061,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-logging.basicConfig(level=logging.INFO)
+# Outermost, so a profile covers admission waits and CORS as well.
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+logging.basicConfig(level=logging.INFO)
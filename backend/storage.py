@@ -0,0 +1,152 @@
+"""Blob storage for image and floorplan bytes: S3-compatible buckets or a local directory.
+
+Everything here is synchronous; the API calls it through
+``asyncio.to_thread``. Presigning is local (no network round trip), so
+handing out upload/download URLs stays cheap.
+"""
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 is only needed when a bucket is configured
+    boto3 = None
+
+
+class S3BlobStore:
+    backend = "s3"
+
+    def __init__(self, bucket: str, endpoint_url: str = None, public_endpoint_url: str = None,
+                 region: str = None, presign_expires: int = 300):
+        if boto3 is None:
+            raise RuntimeError("boto3 is required for S3 storage")
+        self.bucket = bucket
+        self.presign_expires = presign_expires
+        config = Config(signature_version="s3v4", s3={"addressing_style": "path"}, retries={"mode": "standard"})
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region, config=config)
+        # Presigned URLs are signed for the host the browser will use, which in
+        # docker-compose differs from the one the backend reaches MinIO on.
+        if public_endpoint_url and public_endpoint_url != endpoint_url:
+            self.presign_client = boto3.client("s3", endpoint_url=public_endpoint_url, region_name=region, config=config)
+        else:
+            self.presign_client = self.client
+
+    def ensure_bucket(self):
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except ClientError:
+            self.client.create_bucket(Bucket=self.bucket)
+
+    def presign_put(self, key: str, content_type: str, expires: int = None) -> str:
+        return self.presign_client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": self.bucket, "Key": key, "ContentType": content_type},
+            ExpiresIn=expires or self.presign_expires,
+        )
+
+    def presign_get(self, key: str, content_type: str = None, expires: int = None) -> str:
+        params = {"Bucket": self.bucket, "Key": key}
+        if content_type:
+            params["ResponseContentType"] = content_type
+        return self.presign_client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=expires or self.presign_expires
+        )
+
+    def head(self, key: str):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {"size": head["ContentLength"], "content_type": head.get("ContentType")}
+
+    def put(self, key: str, fileobj, content_type: str = "application/octet-stream", metadata: dict = None):
+        extra = {"ContentType": content_type}
+        if metadata:
+            extra["Metadata"] = metadata
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra)
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def open(self, key: str):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_prefix(self, prefix: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys, "Quiet": True})
+
+
+class LocalBlobStore:
+    """Directory-backed store with the same get/put/delete surface as S3BlobStore (no presigning)."""
+
+    backend = "local"
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"invalid key {key!r}")
+        return path
+
+    def head(self, key: str):
+        path = self._path(key)
+        if not path.is_file():
+            return None
+        return {"size": path.stat().st_size, "content_type": None}
+
+    def put(self, key: str, fileobj, content_type: str = "application/octet-stream", metadata: dict = None):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp:
+            shutil.copyfileobj(fileobj, tmp)
+        os.replace(tmp.name, path)
+
+    def get(self, key: str) -> bytes:
+        return self._path(key).read_bytes()
+
+    def open(self, key: str):
+        return self._path(key).open("rb")
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def delete_prefix(self, prefix: str):
+        path = self._path(prefix.rstrip("/"))
+        if path.is_dir():
+            shutil.rmtree(path)
+
+
+def blob_store_from_env():
+    bucket = os.environ.get("S3_BUCKET")
+    if not bucket:
+        return None
+    return S3BlobStore(
+        bucket,
+        endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+        public_endpoint_url=os.environ.get("S3_PUBLIC_ENDPOINT_URL") or None,
+        region=os.environ.get("S3_REGION") or None,
+        presign_expires=int(os.environ.get("S3_PRESIGN_EXPIRES", "300")),
+    )
+
+
+def image_key(project_id: str, image_id: str) -> str:
+    return f"images/{project_id}/{image_id}"
+
+
+def floorplan_key(project_id: str, floorplan_id: str) -> str:
+    return f"floorplans/{project_id}/{floorplan_id}"
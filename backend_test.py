@@ -1,3 +1,4 @@
+import os
 import requests
 import sys
 import json
@@ -6,10 +7,13 @@ from datetime import datetime
 from io import BytesIO
 from PIL import Image
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 class BauDokAPITester:
-    def __init__(self, base_url="https://handover-docs-photo.preview.emergentagent.com"):
+    def __init__(self, base_url="https://handover-docs-photo.preview.emergentagent.com", profile_token=None):
         self.base_url = base_url
+        self.profile_token = profile_token or os.environ.get("PROFILE_TOKEN")
         self.api = f"{base_url}/api"
         self.tests_run = 0
         self.tests_passed = 0
@@ -58,6 +62,16 @@ class BauDokAPITester:
             self.log(f"❌ {name} - Error: {str(e)}")
             return False, {}
 
+    def check(self, name, condition, detail=""):
+        """Record a plain assertion as a test"""
+        self.tests_run += 1
+        if condition:
+            self.tests_passed += 1
+            self.log(f"✅ {name}")
+        else:
+            self.log(f"❌ {name}{' - ' + detail if detail else ''}")
+        return condition
+
     def create_test_image(self):
         """Create a simple test image"""
         img = Image.new('RGB', (100, 100), color='red')
@@ -183,6 +197,93 @@ class BauDokAPITester:
             return response['id']
         return None
 
+    def test_ingest_image(self, project_id, category):
+        """Test asynchronous image ingest and poll until processed"""
+        img_buffer = self.create_test_image()
+        files = {'file': ('ingest.jpg', img_buffer, 'image/jpeg')}
+        success, response = self.run_test(
+            f"Ingest Image: {category}",
+            "POST",
+            f"projects/{project_id}/images/ingest",
+            202,
+            data={'category': category},
+            files=files
+        )
+        if not success or 'id' not in response:
+            return None
+
+        image_id = response['id']
+        for _ in range(20):
+            status = requests.get(f"{self.api}/images/{image_id}/status", timeout=30).json().get("status")
+            if status != "processing":
+                break
+            time.sleep(0.5)
+        self.check("Ingested image ready", status == "ready", str(status))
+        self.image_ids.append(image_id)
+        return image_id if status == "ready" else None
+
+    def test_direct_upload(self, project_id, category):
+        """Test presigned upload: presign, PUT to object storage, finalize, redirected download"""
+        payload = self.create_test_image().getvalue()
+        presign = requests.post(f"{self.api}/projects/{project_id}/images/presign",
+                                json={"filename": "direct.jpg", "content_type": "image/jpeg"}, timeout=30)
+        if presign.status_code == 503:
+            self.log("⚠️ Blob store not configured (S3_BUCKET), skipping direct upload")
+            return None
+        if not self.check("Presign Image Upload", presign.status_code == 200, presign.text[:200]):
+            return None
+        ticket = presign.json()
+
+        put = requests.put(ticket["upload_url"], data=payload, headers=ticket["headers"], timeout=30)
+        if not self.check("PUT to Object Storage", put.status_code == 200, put.text[:200]):
+            return None
+
+        success, image = self.run_test(
+            "Finalize Direct Upload",
+            "POST",
+            f"projects/{project_id}/images/finalize",
+            200,
+            data={"image_id": ticket["image_id"], "category": category, "filename": "direct.jpg"}
+        )
+        if not success:
+            return None
+        self.image_ids.append(image["id"])
+
+        redirect = requests.get(f"{self.api}/images/{image['id']}/data", allow_redirects=False, timeout=30)
+        self.check("Image Data Redirects to Storage", redirect.status_code == 307, str(redirect.status_code))
+        download = requests.get(f"{self.api}/images/{image['id']}/data", timeout=30)
+        self.check("Redirected Download Matches Upload", download.content == payload)
+        return image["id"]
+
+    def test_profiling(self, project_id):
+        """Test opt-in request profiling and the admin profile endpoints"""
+        self.run_test("List Profiles without admin token", "GET", "admin/profiles", 403)
+        if not self.profile_token:
+            self.log("⚠️ PROFILE_TOKEN not set, skipping profiled request")
+            return None
+
+        response = requests.get(f"{self.api}/projects/{project_id}",
+                                headers={"X-Profile": self.profile_token}, timeout=30)
+        profile_id = response.headers.get("X-Profile-Id")
+        if not self.check("Profiled request returns X-Profile-Id", response.status_code == 200 and profile_id):
+            return None
+
+        admin = {"X-Admin-Token": self.profile_token}
+        listed = requests.get(f"{self.api}/admin/profiles", headers=admin, timeout=30)
+        self.check("Profile listed", listed.status_code == 200 and profile_id in [p["id"] for p in listed.json()])
+        detail = requests.get(f"{self.api}/admin/profiles/{profile_id}", headers=admin, timeout=30)
+        if not self.check("Get Profile", detail.status_code == 200, str(detail.status_code)):
+            return None
+        record = detail.json()
+        self.check("Profile traced Mongo commands",
+                   record["path"] == f"/api/projects/{project_id}" and record["mongo_count"] > 0
+                   and {"find"} <= {c["command"] for c in record["mongo"]}, str(record.get("mongo")))
+        unprofiled = requests.get(f"{self.api}/projects/{project_id}", timeout=30)
+        self.check("Unprofiled request has no X-Profile-Id", "X-Profile-Id" not in unprofiled.headers)
+        missing = requests.get(f"{self.api}/admin/profiles/non-existent", headers=admin, timeout=30)
+        self.check("Get Non-existent Profile", missing.status_code == 404, str(missing.status_code))
+        return record
+
     def test_get_project_images(self, project_id, category=None, tag=None, date_from=None, date_to=None):
         """Test getting project images with filters including tag filter"""
         endpoint = f"projects/{project_id}/images"
@@ -208,6 +309,38 @@ class BauDokAPITester:
         )
         return success, response
 
+    def test_get_image_facets(self, project_id, bucket="day"):
+        """Test faceted image counts"""
+        success, response = self.run_test(
+            f"Get Image Facets (bucket: {bucket})",
+            "GET",
+            f"projects/{project_id}/images/facets?bucket={bucket}",
+            200
+        )
+        return success, response
+
+    def test_facet_counts(self, project_id):
+        """Test facet counts against the project's images, and that a new upload invalidates the cache"""
+        _, images = self.test_get_project_images(project_id)
+        success, facets = self.test_get_image_facets(project_id)
+        if not success:
+            return False
+        categories = Counter(i["category"] for i in images)
+        tags = Counter(t for i in images for t in i.get("tags") or [])
+        self.check("Facet total matches images", facets["total"] == len(images), f"{facets['total']} != {len(images)}")
+        self.check("Facet category counts match", all(facets["category"].get(c, 0) == n for c, n in categories.items()),
+                   str(facets["category"]))
+        self.check("Facet tag counts match", all(facets["tag"].get(t, 0) == n for t, n in tags.items()), str(facets["tag"]))
+
+        # Read again right after a write: the cached entry must not be served
+        self.test_upload_image(project_id, "atadas", "Facet cache check", tags="klíma")
+        _, after = self.test_get_image_facets(project_id)
+        self.check("Facets invalidated after upload",
+                   after.get("total") == facets["total"] + 1
+                   and after["category"]["atadas"] == facets["category"]["atadas"] + 1
+                   and after["tag"]["klíma"] == facets["tag"]["klíma"] + 1, str(after))
+        return True
+
     def test_get_image_data(self, image_id):
         """Test getting image binary data"""
         success, _ = self.run_test(
@@ -218,6 +351,13 @@ class BauDokAPITester:
         )
         return success
 
+    def test_gallery_downloads(self, image_ids, parallel=12):
+        """Test that a gallery's worth of parallel downloads from one client is not rate limited"""
+        urls = [f"{self.api}/images/{image_ids[i % len(image_ids)]}/data" for i in range(parallel)]
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            statuses = list(pool.map(lambda url: requests.get(url, timeout=30).status_code, urls))
+        return self.check(f"Gallery: {parallel} parallel image downloads", all(s == 200 for s in statuses), str(statuses))
+
     def test_update_image_description(self, image_id, description):
         """Test updating image description"""
         success, response = self.run_test(
@@ -326,6 +466,49 @@ class BauDokAPITester:
         )
         return success
 
+    def test_render_floorplan(self, floorplan_id, width=300):
+        """Test server-side floorplan rendering with markers and its ETag revalidation"""
+        url = f"{self.api}/floorplans/{floorplan_id}/render?width={width}"
+        response = requests.get(url, timeout=60)
+        if response.status_code == 501:
+            self.log("⚠️ Rendering not available (Pillow missing), skipping")
+            return False
+        if not self.check(f"Render Floorplan (width {width})", response.status_code == 200, response.text[:200]):
+            return False
+        with Image.open(BytesIO(response.content)) as rendered:
+            self.check("Rendered PNG has requested width", rendered.format == "PNG" and rendered.width == width,
+                       f"{rendered.format} {rendered.size}")
+        cached = requests.get(url, headers={"If-None-Match": response.headers.get("ETag", "")}, timeout=30)
+        self.check("Render revalidates with 304", cached.status_code == 304, str(cached.status_code))
+        self.run_test("Render with invalid width", "GET", f"floorplans/{floorplan_id}/render?width=10", 400)
+        return True
+
+    def test_render_tall_floorplan(self, project_id):
+        """Test that a narrow, tall plan rendered at maximum width stays within the pixel cap"""
+        img_buffer = BytesIO()
+        Image.new('RGB', (10, 2000), color='white').save(img_buffer, format='PNG')
+        response = requests.post(f"{self.api}/projects/{project_id}/floorplans",
+                                 files={'file': ('tall.png', img_buffer.getvalue(), 'image/png')},
+                                 data={'name': 'Tall Plan'}, timeout=30)
+        if not self.check("Upload Tall Floorplan", response.status_code == 200, response.text[:200]):
+            return False
+        ok = True
+        for fmt in ("png", "webp"):
+            rendered = requests.get(f"{self.api}/floorplans/{response.json()['id']}/render?width=4096&format={fmt}",
+                                    timeout=60)
+            if rendered.status_code == 501:
+                return False
+            if not self.check(f"Render Tall Floorplan ({fmt})", rendered.status_code == 200, rendered.text[:200]):
+                ok = False
+                continue
+            with Image.open(BytesIO(rendered.content)) as image:
+                # WebP additionally caps each side at 16383 px
+                max_side = 16383 if fmt == "webp" else image.height
+                ok &= self.check(f"Tall {fmt} render within limits",
+                                 image.format == fmt.upper() and image.width * image.height <= 4096 * 4096
+                                 and max(image.size) <= max_side, f"{image.format} {image.size}")
+        return ok
+
     def test_get_floorplan_images(self, floorplan_id):
         """Test getting images marked on floorplan"""
         success, response = self.run_test(
@@ -351,6 +534,69 @@ class BauDokAPITester:
         )
         return success
 
+    def test_bulk_update_images(self, items):
+        """Test bulk image update"""
+        success, response = self.run_test(
+            f"Bulk Update {len(items)} Images",
+            "POST",
+            "images/bulk",
+            200,
+            data={"items": items}
+        )
+        return success, response
+
+    def wait_for_archive_state(self, project_id):
+        for _ in range(40):
+            project = requests.get(f"{self.api}/projects/{project_id}", timeout=30).json()
+            if project.get("archive_state") not in ("archiving", "restoring"):
+                return project
+            time.sleep(0.5)
+        return project
+
+    def test_archive_round_trip(self):
+        """Test archiving a project to the cold tier, reading through it and restoring it"""
+        project_id = self.test_create_project("Archive Test Project")
+        if not project_id:
+            return False
+        image_id = self.test_upload_image(project_id, "atadas", "Archived image")
+        floorplan_id = self.test_upload_floorplan(project_id, "Archived Plan")
+        image_bytes = requests.get(f"{self.api}/images/{image_id}/data", timeout=30).content
+        plan_bytes = requests.get(f"{self.api}/floorplans/{floorplan_id}/data", timeout=30).content
+
+        response = requests.post(f"{self.api}/projects/{project_id}/archive", timeout=30)
+        if response.status_code == 503:
+            self.log("⚠️ Cold storage not configured (COLD_STORAGE), skipping archive round trip")
+            self.test_delete_project(project_id)
+            return None
+        self.check("Archive Project accepted", response.status_code == 202, str(response.status_code))
+        project = self.wait_for_archive_state(project_id)
+        image = next((i for i in project.get("images", []) if i["id"] == image_id), {})
+        self.check("Project archived", project.get("archive_state") == "archived" and project.get("archived") is True,
+                   str(project.get("archive_state")))
+        self.check("Image moved to cold tier", "cold" in image, str(image.keys()))
+
+        for attempt in ("cold", "cached"):
+            data = requests.get(f"{self.api}/images/{image_id}/data", timeout=30)
+            self.check(f"Archived image readable ({attempt})", data.status_code == 200 and data.content == image_bytes)
+        data = requests.get(f"{self.api}/floorplans/{floorplan_id}/data", timeout=30)
+        self.check("Archived floorplan readable", data.status_code == 200 and data.content == plan_bytes)
+        stats = requests.get(f"{self.api}/metrics/cold", timeout=30).json()
+        self.check("Cold reads served from cache", stats.get("fetches", 0) >= 1
+                   and stats.get("memory_hits", 0) + stats.get("disk_hits", 0) >= 1, str(stats))
+
+        response = requests.post(f"{self.api}/projects/{project_id}/restore", timeout=30)
+        self.check("Restore Project accepted", response.status_code == 202, str(response.status_code))
+        project = self.wait_for_archive_state(project_id)
+        image = next((i for i in project.get("images", []) if i["id"] == image_id), {})
+        self.check("Project restored", project.get("archive_state") == "active" and not project.get("archived"),
+                   str(project.get("archive_state")))
+        self.check("Image back inline", "cold" not in image, str(image.keys()))
+        data = requests.get(f"{self.api}/images/{image_id}/data", timeout=30)
+        self.check("Restored image matches original", data.status_code == 200 and data.content == image_bytes)
+
+        self.test_delete_project(project_id)
+        return True
+
     def test_delete_floorplan(self, floorplan_id):
         """Test floorplan deletion"""
         success, response = self.run_test(
@@ -380,6 +626,10 @@ class BauDokAPITester:
             self.log("❌ API root test failed - stopping tests")
             return False
 
+        # Test liveness and readiness probes
+        self.run_test("Liveness Probe", "GET", "health/live", 200)
+        self.run_test("Readiness Probe", "GET", "health/ready", 200)
+
         # Test predefined tags endpoint
         success, tags_response = self.test_get_tags()
         if not success:
@@ -403,6 +653,9 @@ class BauDokAPITester:
         # Test getting specific project
         self.test_get_project(project_id)
 
+        # Test request profiling (needs PROFILE_TOKEN matching the backend's)
+        self.test_profiling(project_id)
+
         # Test project update
         self.test_update_project(project_id, "Updated Test Project", "Updated description")
 
@@ -439,6 +692,14 @@ class BauDokAPITester:
         # Test getting project images
         self.test_get_project_images(project_id)
         
+        # Test asynchronous ingest
+        ingested_id = self.test_ingest_image(project_id, "alapszereles")
+        if ingested_id:
+            self.test_get_image_data(ingested_id)
+
+        # Test presigned direct-to-storage upload (needs S3_BUCKET, e.g. MinIO or moto)
+        self.test_direct_upload(project_id, "atadas")
+
         # Test filtering by category
         for category in categories:
             self.test_get_project_images(project_id, category=category)
@@ -452,6 +713,15 @@ class BauDokAPITester:
         today = datetime.now().strftime("%Y-%m-%d")
         self.test_get_project_images(project_id, date_from=today, date_to=today)
 
+        # Test facet counts for the filter bar
+        self.test_facet_counts(project_id)
+        self.test_get_image_facets(project_id, bucket="month")
+        self.run_test("Get Image Facets with invalid bucket", "GET", f"projects/{project_id}/images/facets?bucket=week", 400)
+
+        # Test a gallery page loading all thumbnails at once
+        if uploaded_images:
+            self.test_gallery_downloads([image_id for image_id, _ in uploaded_images])
+
         # Test image operations
         for image_id, category in uploaded_images:
             # Test getting image data
@@ -505,12 +775,31 @@ class BauDokAPITester:
                 
                 # Test getting images on floorplan
                 self.test_get_floorplan_images(floorplan_id)
+
+                # Test rendering the plan with its markers
+                self.test_render_floorplan(floorplan_id)
                 
                 # Position another image if available
                 if len(uploaded_images) > 1:
                     image_id2 = uploaded_images[1][0]
                     self.test_position_image_on_floorplan(image_id2, floorplan_id, 80.0, 20.0)
+
+                # Test bulk retagging and detaching, including a missing image
+                success, response = self.test_bulk_update_images([
+                    {"id": image_id, "add_tags": ["hiba"], "remove_tags": ["szigetelés"]},
+                    {"id": image_id, "floorplan_id": ""},
+                    {"id": "non-existent", "description": "x"}
+                ])
+                if success:
+                    statuses = [r["status"] for r in response.get("results", [])]
+                    self.check("Bulk statuses", statuses == ["matched", "matched", "not_found"], str(statuses))
+                    _, project = self.test_get_project(project_id)
+                    image = next((i for i in project.get("images", []) if i["id"] == image_id), {})
+                    self.check("Bulk tag add/remove", image.get("tags") == ["gipszkarton", "javítás", "hiba"], str(image.get("tags")))
+                    self.check("Bulk detach from floorplan", image.get("floorplan_id") is None, str(image.get("floorplan_id")))
             
+            self.test_render_tall_floorplan(project_id)
+
             # Test floorplan deletion (should unlink positioned images)
             self.test_delete_floorplan(floorplan_id)
 
@@ -522,6 +811,9 @@ class BauDokAPITester:
         # Test project deletion (this will also delete remaining images and floorplans)
         self.test_delete_project(project_id)
 
+        # Test archiving to cold storage and restoring (needs COLD_STORAGE on the backend)
+        self.test_archive_round_trip()
+
         # Test getting non-existent resources (should return 404)
         self.run_test("Get Non-existent Project", "GET", f"projects/non-existent", 404)
         self.run_test("Get Non-existent Image", "GET", f"images/non-existent/data", 404)
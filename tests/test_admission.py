@@ -0,0 +1,190 @@
+import asyncio
+import json
+
+from admission import AdmissionController, AdmissionMiddleware
+
+MB = 1024 * 1024
+
+
+def controller(**overrides):
+    options = dict(max_bytes=100, max_concurrent=2, max_queue=2, queue_timeout=0.2,
+                   client_max_concurrent=2, client_max_bytes=60, retry_after=7)
+    options.update(overrides)
+    return AdmissionController(**options)
+
+
+def test_admits_within_budget_and_releases():
+    async def scenario():
+        c = controller()
+        assert await c.acquire("a", 30) is None
+        assert (c.in_flight, c.bytes_in_use, c.clients) == (1, 30, {"a": [1, 30]})
+        await c.release("a", 30)
+        assert (c.in_flight, c.bytes_in_use, c.clients) == (0, 0, {})
+    asyncio.run(scenario())
+
+
+def test_too_large_is_413():
+    async def scenario():
+        c = controller()
+        assert await c.acquire("a", 101) == 413
+        assert await c.acquire("a", 61) == 413
+        assert c.snapshot()["rejected_too_large"] == 2
+        assert c.clients == {}
+    asyncio.run(scenario())
+
+
+def test_client_quota_is_429():
+    async def scenario():
+        c = controller(max_concurrent=10)
+        assert await c.acquire("a", 10) is None
+        assert await c.acquire("a", 10) is None
+        assert await c.acquire("a", 10) == 429  # concurrency
+        assert await c.acquire("b", 50) is None
+        assert await c.acquire("b", 20) == 429  # bytes
+        assert c.snapshot()["rejected_quota"] == 2
+    asyncio.run(scenario())
+
+
+def test_downloads_skip_client_quota():
+    async def scenario():
+        c = controller(max_concurrent=16, max_bytes=64 * MB, client_max_concurrent=4, client_max_bytes=16 * MB)
+        results = await asyncio.gather(*(c.acquire(None, 4 * MB) for _ in range(12)))
+        assert results == [None] * 12
+        assert c.clients == {}
+    asyncio.run(scenario())
+
+
+def test_queued_request_is_admitted_on_release():
+    async def scenario():
+        c = controller(queue_timeout=1)
+        assert await c.acquire("a", 50) is None
+        assert await c.acquire("b", 50) is None
+        waiter = asyncio.create_task(c.acquire("c", 50))
+        await asyncio.sleep(0.01)
+        assert c.waiting == 1
+        await c.release("a", 50)
+        assert await waiter is None
+        assert c.snapshot()["queued"] == 1
+        assert (c.in_flight, c.bytes_in_use) == (2, 100)
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_is_503_and_frees_client():
+    async def scenario():
+        c = controller()
+        assert await c.acquire("a", 50) is None
+        assert await c.acquire("b", 50) is None
+        assert await c.acquire("c", 50) == 503
+        assert c.snapshot()["timed_out"] == 1
+        assert "c" not in c.clients and c.waiting == 0
+    asyncio.run(scenario())
+
+
+def test_full_queue_is_503():
+    async def scenario():
+        c = controller(max_queue=1)
+        assert await c.acquire("a", 50) is None
+        assert await c.acquire("b", 50) is None
+        waiter = asyncio.create_task(c.acquire("c", 10))
+        await asyncio.sleep(0.01)
+        assert await c.acquire("d", 10) == 503
+        assert c.snapshot()["rejected_busy"] == 1
+        assert "d" not in c.clients
+        await waiter
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_frees_client():
+    async def scenario():
+        c = controller(queue_timeout=5)
+        assert await c.acquire("a", 50) is None
+        assert await c.acquire("b", 50) is None
+        waiter = asyncio.create_task(c.acquire("c", 5))
+        await asyncio.sleep(0.01)
+        assert c.clients["c"] == [1, 5]
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert "c" not in c.clients and c.waiting == 0
+    asyncio.run(scenario())
+
+
+async def call(middleware, method, path, headers=(), client=("10.0.0.1", 1234)):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": list(headers), "client": client}
+    await middleware(scope, receive, send)
+    start = messages[0]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], dict(start["headers"]), body
+
+
+def app_recording(seen):
+    async def app(scope, receive, send):
+        seen.append(scope["path"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+    return app
+
+
+UPLOAD = "/api/projects/p1/images"
+
+
+def test_middleware_rejects_missing_and_malformed_length():
+    async def scenario():
+        seen = []
+        mw = AdmissionMiddleware(app_recording(seen), controller())
+        status, _, body = await call(mw, "POST", UPLOAD)
+        assert status == 411
+        assert "Content-Length" in json.loads(body)["detail"]
+        for bad in (b"abc", b"-5"):
+            status, _, _ = await call(mw, "POST", UPLOAD, [(b"content-length", bad)])
+            assert status == 400
+        assert seen == []
+    asyncio.run(scenario())
+
+
+def test_middleware_413_and_retry_after_on_429():
+    async def scenario():
+        c = controller(client_max_concurrent=0)
+        mw = AdmissionMiddleware(app_recording([]), c, memory_factor=3.0)
+        status, headers, _ = await call(mw, "POST", UPLOAD, [(b"content-length", b"40")])
+        assert status == 413 and b"retry-after" not in headers
+        status, headers, body = await call(mw, "POST", UPLOAD, [(b"content-length", b"5")])
+        assert status == 429
+        assert headers[b"retry-after"] == b"7"
+        assert headers[b"content-type"] == b"application/json"
+        assert json.loads(body)["detail"]
+    asyncio.run(scenario())
+
+
+def test_middleware_passes_other_routes_and_releases():
+    async def scenario():
+        seen = []
+        c = controller()
+        mw = AdmissionMiddleware(app_recording(seen), c, memory_factor=3.0, download_bytes=10)
+        assert (await call(mw, "GET", "/api/projects"))[0] == 200
+        assert (await call(mw, "GET", "/api/images/i1/data"))[0] == 200
+        assert (await call(mw, "POST", UPLOAD, [(b"content-length", b"10")]))[0] == 200
+        assert seen == ["/api/projects", "/api/images/i1/data", UPLOAD]
+        snapshot = c.snapshot()
+        assert (snapshot["admitted"], snapshot["in_flight"], snapshot["bytes_in_use"]) == (2, 0, 0)
+    asyncio.run(scenario())
+
+
+def test_client_key_from_forwarded_for():
+    headers = {b"x-forwarded-for": b"6.6.6.6, 203.0.113.9, 10.0.0.5"}
+    scope = {"client": ("10.0.0.1", 1234)}
+    direct = AdmissionMiddleware(None, controller())
+    assert direct._client(scope, headers) == "10.0.0.1"
+    one_proxy = AdmissionMiddleware(None, controller(), trusted_proxies=1)
+    assert one_proxy._client(scope, headers) == "10.0.0.5"
+    two_proxies = AdmissionMiddleware(None, controller(), trusted_proxies=2)
+    assert two_proxies._client(scope, headers) == "203.0.113.9"
+    # Fewer hops than trusted proxies: the header cannot be trusted at all.
+    assert AdmissionMiddleware(None, controller(), trusted_proxies=4)._client(scope, headers) == "10.0.0.1"
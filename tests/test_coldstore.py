@@ -0,0 +1,74 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coldstore import ColdStore, cold_key
+from storage import LocalBlobStore
+
+
+def make(tmp_path, memory_bytes=0, disk_bytes=250):
+    return ColdStore(LocalBlobStore(tmp_path / "store"), tmp_path / "cache", memory_bytes, disk_bytes)
+
+
+def payload(i):
+    return bytes([i]) * 100
+
+
+def test_round_trip_through_tiers(tmp_path):
+    cold = make(tmp_path, memory_bytes=1000)
+    ref = cold.put(cold_key("images", "p1", "a"), payload(1))
+    assert ref["codec"] == "zlib" and ref["size"] == 100 and ref["stored_size"] < 100
+
+    assert cold.fetch(ref) == payload(1)  # from the store
+    assert cold.fetch(ref) == payload(1)  # from memory
+    cold.forget(ref["sha256"])
+    assert cold.fetch(ref) == payload(1)  # store again, the disk copy went with forget()
+    cold.memory.clear()
+    cold.memory_size = 0
+    assert cold.fetch(ref) == payload(1)  # disk
+    assert {k: cold.stats()[k] for k in ("fetches", "memory_hits", "disk_hits")} == \
+        {"fetches": 2, "memory_hits": 1, "disk_hits": 1}
+
+
+def test_hash_mismatch_is_rejected(tmp_path):
+    cold = make(tmp_path)
+    ref = cold.put(cold_key("images", "p1", "a"), payload(1))
+    with pytest.raises(ValueError):
+        cold.fetch({**ref, "sha256": "0" * 64})
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cold = make(tmp_path, disk_bytes=250)
+    refs = [cold.put(cold_key("images", "p1", str(i)), payload(i)) for i in range(3)]
+    cold.fetch(refs[0])
+    cold.fetch(refs[1])
+    cold.fetch(refs[0])  # disk hit, now most recently used
+    cold.fetch(refs[2])  # pushes the cache to 300 bytes, evicting refs[1]
+
+    assert sorted(os.listdir(tmp_path / "cache")) == sorted([refs[0]["sha256"], refs[2]["sha256"]])
+    assert cold.stats()["disk_bytes"] == 200
+
+
+def test_disk_index_survives_restart(tmp_path):
+    cold = make(tmp_path)
+    refs = [cold.put(cold_key("images", "p1", str(i)), payload(i)) for i in range(2)]
+    for ref in refs:
+        cold.fetch(ref)
+    (tmp_path / "cache" / "stale.tmp").write_bytes(b"x")
+
+    reopened = make(tmp_path)
+    assert (reopened.stats()["disk_entries"], reopened.stats()["disk_bytes"]) == (2, 200)
+    assert not (tmp_path / "cache" / "stale.tmp").exists()
+    assert reopened.fetch(refs[1]) == payload(1)
+    assert reopened.stats()["disk_hits"] == 1
+
+
+def test_counters_are_consistent_under_threads(tmp_path):
+    cold = make(tmp_path, disk_bytes=10_000)
+    refs = [cold.put(cold_key("images", "p1", str(i)), payload(i)) for i in range(4)]
+    for ref in refs:
+        cold.fetch(ref)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(cold.fetch, refs * 200))
+    assert cold.stats()["disk_hits"] == 800
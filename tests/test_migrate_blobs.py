@@ -0,0 +1,126 @@
+import base64
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import mongomock
+import pytest
+from moto import mock_aws
+
+import migrate_blobs
+from migrate_blobs import Checkpoint, Migrator, parse_args
+from storage import S3BlobStore, image_key
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    with mock_aws():
+        s3 = S3BlobStore("baudok-test", region="us-east-1")
+        s3.ensure_bucket()
+        yield s3
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().baudok
+    for i in range(7):
+        raw = f"image-{i}".encode() * 10
+        db.images.insert_one({"id": f"img{i}", "project_id": "p1", "content_type": "image/jpeg",
+                              "data": base64.b64encode(raw).decode()})
+    return db
+
+
+def migrate(db, store, tmp_path, *extra, restart=False):
+    args = parse_args(["--checkpoint", str(tmp_path / "checkpoint.json"), "--batch-size", "3", *extra])
+    checkpoint = Checkpoint(args.checkpoint, restart)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return Migrator(db, store, args).run("images", checkpoint, pool)
+
+
+class Wrapped:
+    """Delegates to the real store, with a hook that runs before each put."""
+
+    def __init__(self, store, before_put):
+        self.store = store
+        self.before_put = before_put
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def put(self, key, fileobj, *args, **kwargs):
+        fileobj = self.before_put(key, fileobj) or fileobj
+        return self.store.put(key, fileobj, *args, **kwargs)
+
+
+def test_migrates_and_verifies(db, store, tmp_path):
+    assert migrate(db, store, tmp_path) == (7, 0)
+    assert db.images.count_documents({"data": {"$exists": True}}) == 0
+    doc = db.images.find_one({"id": "img3"})
+    raw = b"image-3" * 10
+    assert doc["blob"] == {"backend": "s3", "key": image_key("p1", "img3"), "size": len(raw),
+                           "sha256": hashlib.sha256(raw).hexdigest()}
+    assert store.get(doc["blob"]["key"]) == raw
+
+
+def test_interrupted_run_resumes_from_checkpoint(db, store, tmp_path):
+    puts = []
+
+    def crash_in_second_batch(key, fileobj):
+        puts.append(key)
+        if len(puts) == 4:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        migrate(db, Wrapped(store, crash_in_second_batch), tmp_path)
+    state = json.loads((tmp_path / "checkpoint.json").read_text())
+    assert state["images"]["migrated"] == 3
+    # Puts already handed to the pool still finish, but the batch is never checkpointed.
+    swapped = db.images.count_documents({"blob": {"$exists": True}})
+    assert 3 < swapped < 7
+
+    assert migrate(db, store, tmp_path) == (7 - swapped, 0)
+    assert db.images.count_documents({"data": {"$exists": True}}) == 0
+    assert json.loads((tmp_path / "checkpoint.json").read_text())["images"]["migrated"] == 3 + 7 - swapped
+
+
+def test_failed_ids_are_retried_on_resume(db, store, tmp_path):
+    def corrupt_img1(key, fileobj):
+        if key.endswith("/img1"):
+            return type(fileobj)(b"not the original bytes")
+
+    assert migrate(db, Wrapped(store, corrupt_img1), tmp_path) == (7, 1)
+    assert "data" in db.images.find_one({"id": "img1"})  # hash mismatch: document untouched
+    assert json.loads((tmp_path / "checkpoint.json").read_text())["images"]["failed"] == ["img1"]
+
+    # Nothing left past the checkpoint, but the failed id is retried and cleared.
+    assert migrate(db, store, tmp_path) == (0, 0)
+    assert "blob" in db.images.find_one({"id": "img1"})
+    assert json.loads((tmp_path / "checkpoint.json").read_text())["images"]["failed"] == []
+
+
+def test_dry_run_writes_nothing(db, store, tmp_path):
+    assert migrate(db, store, tmp_path, "--dry-run") == (7, 0)
+    assert db.images.count_documents({"data": {"$exists": True}}) == 7
+    assert store.client.list_objects_v2(Bucket=store.bucket).get("KeyCount") == 0
+    assert not (tmp_path / "checkpoint.json").exists()
+
+
+def test_document_deleted_mid_swap_drops_object(db, store, tmp_path):
+    def delete_img2(key, fileobj):
+        if key.endswith("/img2"):
+            db.images.delete_one({"id": "img2"})
+
+    assert migrate(db, Wrapped(store, delete_img2), tmp_path) == (7, 0)
+    assert store.head(image_key("p1", "img2")) is None
+    assert store.head(image_key("p1", "img3")) is not None
+
+
+def test_main_exit_code_ignores_earlier_failures(db, store, tmp_path, monkeypatch):
+    (tmp_path / "checkpoint.json").write_text(json.dumps({"images": {"failed": ["gone"]}}))
+    monkeypatch.setattr(migrate_blobs, "blob_store_from_env", lambda: store)
+    monkeypatch.setattr(migrate_blobs, "MongoClient", lambda url: mongomock.MongoClient(_store=db.client._store))
+    monkeypatch.setenv("MONGO_URL", "mongodb://test")
+    monkeypatch.setenv("DB_NAME", "baudok")
+    assert migrate_blobs.main(["--checkpoint", str(tmp_path / "checkpoint.json"), "--collections", "images"]) == 0